@@ -0,0 +1,143 @@
+"""
+Benchmark of the epoch assembly of a session on synthetic runs.
+
+Compares the previous assembly (pairwise `mne.concatenate_epochs` after each
+run, followed by a copied zscore baseline) with `assemble_session` (one
+preallocated array and an in-place zscore baseline), checks that both give
+the same data and events, and reports wall time and peak RSS of each. Each
+method runs in its own process so that the peak RSS is not shared.
+
+Usage:
+
+    % python scripts/bench_preproc_session.py --n-runs 10 --n-events 100
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import mne
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src.preproc_thingsmeg import assemble_session, epoch_run
+
+mne.set_log_level("WARNING")
+
+pre_stim_time = -0.1
+post_stim_time = 1.3
+
+
+def make_synthetic_runs(output_dir, n_runs, n_events, n_channels, sfreq):
+    # synthetic filtered runs (saved as fif) and their events
+    rng = np.random.default_rng(0)
+    info = mne.create_info([f"M{i:03d}" for i in range(n_channels)], sfreq, "mag")
+    run_files = []
+    for run in range(n_runs):
+        n_times = int((n_events + 2) * 1.5 * sfreq)
+        raw = mne.io.RawArray(rng.standard_normal((n_channels, n_times)) * 1e-13, info, verbose=False)
+        onsets = (np.arange(n_events) + 1) * int(1.5 * sfreq)
+        # the last event is too close to the end of the run and is dropped
+        onsets[-1] = n_times - int(0.5 * sfreq)
+        events = np.column_stack([onsets, np.zeros(n_events, dtype=int), rng.integers(1, 3, n_events)])
+        raw_file = os.path.join(output_dir, f"run-{run:02d}_raw.fif")
+        raw.save(raw_file, fmt="double", verbose=False)
+        run_files.append((raw_file, os.path.join(output_dir, f"run-{run:02d}-eve.npy")))
+        np.save(run_files[-1][1], events)
+    return run_files
+
+
+def peak_rss():
+    # peak RSS (bytes) of the current process
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def read_run(raw_file, event_file):
+    return mne.io.read_raw_fif(raw_file, preload=True, verbose=False), np.load(event_file)
+
+
+def legacy_preprocessing(run_files):
+    # previous assembly in run_preprocessing
+    epochs = []
+    for raw_file, event_file in run_files:
+        raw, events = read_run(raw_file, event_file)
+        if epochs:
+            epochs_1 = mne.Epochs(raw, events, tmin=pre_stim_time, tmax=post_stim_time, picks="mag", baseline=None, verbose=False)
+            epochs_1.info["dev_head_t"] = epochs.info["dev_head_t"]
+            epochs = mne.concatenate_epochs([epochs, epochs_1], verbose=False)
+        else:
+            epochs = mne.Epochs(raw, events, tmin=pre_stim_time, tmax=post_stim_time, picks="mag", baseline=None, verbose=False)
+        epochs.drop_bad(verbose=False)
+    baselined_epochs = mne.baseline.rescale(data=epochs.get_data(), times=epochs.times, baseline=(None, 0), mode="zscore", copy=False, verbose=False)
+    return mne.EpochsArray(baselined_epochs, epochs.info, epochs.events, epochs.tmin, event_id=epochs.event_id, verbose=False)
+
+
+def preprocessing(run_files):
+    # assembly in run_preprocessing
+    def iter_run_epochs():
+        for raw_file, event_file in run_files:
+            raw, events = read_run(raw_file, event_file)
+            yield epoch_run(raw, events, pre_stim_time, post_stim_time)
+
+    n_events = sum(len(np.load(event_file)) for _, event_file in run_files)
+    return assemble_session(iter_run_epochs(), n_events)
+
+
+def _run(queue, func, run_files, output_file):
+    t0 = time.perf_counter()
+    epochs = func(run_files)
+    elapsed = time.perf_counter() - t0
+    np.savez(output_file, data=epochs.get_data(copy=False), events=epochs.events)
+    queue.put((elapsed, peak_rss()))
+
+
+def run_benchmark(func, run_files, output_file):
+    # run `func` in a new process and return wall time (s) and peak RSS (bytes)
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(target=_run, args=(queue, func, run_files, output_file))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-runs", type=int, default=10)
+    parser.add_argument("--n-events", type=int, default=100, help="Events per run.")
+    parser.add_argument("--n-channels", type=int, default=272)
+    parser.add_argument("--sfreq", type=float, default=1200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        run_files = make_synthetic_runs(tmp_dir, args.n_runs, args.n_events, args.n_channels, args.sfreq)
+
+        results = {}
+        for name, func in [("legacy", legacy_preprocessing), ("one-shot", preprocessing)]:
+            results[name] = run_benchmark(func, run_files, os.path.join(tmp_dir, f"{name}.npz"))
+
+        legacy = np.load(os.path.join(tmp_dir, "legacy.npz"))
+        one_shot = np.load(os.path.join(tmp_dir, "one-shot.npz"))
+        assert np.array_equal(legacy["data"], one_shot["data"]), "data differ"
+        assert np.array_equal(legacy["events"], one_shot["events"]), "events differ"
+        session_size = one_shot["data"].nbytes
+
+    print(f"Session: {args.n_runs} runs x {args.n_events} events ({session_size / 1024 ** 3:.2f} GiB of epochs)")
+    print(f"{'method':<12} {'time (s)':>10} {'peak RSS (GiB)':>16} {'peak / session':>16}")
+    for name, (t, peak) in results.items():
+        print(f"{name:<12} {t:>10.2f} {peak / 1024 ** 3:>16.2f} {peak / session_size:>16.2f}")
+    t_legacy, peak_legacy = results["legacy"]
+    t, peak = results["one-shot"]
+    print(f"one-shot: {t_legacy / t:.1f}x faster, {peak_legacy / peak:.1f}x less peak memory")
@@ -0,0 +1,263 @@
+"""
+Benchmark suite of the THINGS-MEG converter on synthetic data.
+
+Generates synthetic inputs with the layouts of the real data, and times
+the two steps of `make.py` at several scales:
+
+- `preproc`: `preproc_thingsmeg` (custom preprocessing) on a BIDS tree of
+  12 sessions of raw runs (with the CTF channel names, the trigger
+  channel, and `events.tsv`) and `sample_attributes_P1.csv`. MNE cannot
+  write CTF files, so the runs are fif files at the paths of the CTF runs
+  (`_meg.ds`), read in the benchmark process with `read_synthetic_run`.
+- `export`: `make_bdata_thingsmeg` on preprocessed epochs
+  (`mne.EpochsArray` saved to fif and read with `preload=False`, as the
+  preprocessed data) with `trial_type`/`category_nr`/`image_path` metadata.
+
+Each benchmark runs in its own process. The wall time, the throughput
+(trials/s, and MB/s of input data), and the peak RSS of the process and of
+its workers are appended to a results file (JSONL) with the current commit,
+so that the results of two commits can be compared:
+
+    % python scripts/bench_suite.py --scales small medium
+    % python scripts/bench_suite.py --compare <commit> <commit>
+
+Scales (per participant):
+
+- small: 12 sessions x 2 runs x 24 trials, 32 channels (preproc); 2,000 epochs of 64 channels x 141 samples (export)
+- medium: 12 sessions x 4 runs x 50 trials, 64 channels; 8,000 epochs of 272 channels x 141 samples
+- large: 12 sessions x 10 runs x 100 trials, 128 channels; 27,000 epochs of 272 channels x 281 samples
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import logging
+
+import mne
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(root_dir)
+from src.make_bdata_thingsmeg import make_bdata_thingsmeg
+from src.preproc_thingsmeg import n_sessions, preproc_thingsmeg, trigger_amplitude, trigger_channel
+
+mne.set_log_level("WARNING")
+
+
+def read_synthetic_run(fname, preload=False, **kwargs):
+    # reader of the synthetic runs (fif files named as CTF runs), in place of mne.io.read_raw_ctf
+    return mne.io.read_raw_fif(fname, preload=preload, verbose=False)
+
+
+# set at import, so that the spawned benchmark processes and their session workers (which import this script) use it
+mne.io.read_raw_ctf = read_synthetic_run
+
+scales = {
+    "small": {"preproc": dict(n_runs=2, n_trials=24, n_channels=32), "export": dict(n_epochs=2000, n_channels=64, n_times=141)},
+    "medium": {"preproc": dict(n_runs=4, n_trials=50, n_channels=64), "export": dict(n_epochs=8000, n_channels=272, n_times=141)},
+    "large": {"preproc": dict(n_runs=10, n_trials=100, n_channels=128), "export": dict(n_epochs=27000, n_channels=272, n_times=281)},
+}
+
+sfreq = 1200.
+trial_interval = 1.5 # s
+
+
+def channel_names(n_channels):
+    # CTF-like channel names (MRO11-1609 is dropped by read_raw)
+    names = [f"M{'LRZ'[i % 3]}{'CFOPT'[i % 5]}{11 + i // 15}{i % 9}-1609" for i in range(n_channels)]
+    return names + ["MRO11-1609"]
+
+
+def trial_attributes(rng, n_trials, n_categories=200, n_test_images=20):
+    # trial_type, category_nr and image_path of the trials (as sample_attributes_P*.csv)
+    trial_type = rng.choice(["exp", "test", "catch"], n_trials, p=[0.8, 0.15, 0.05])
+    category_nr = rng.integers(1, n_categories + 1, n_trials).astype(float)
+    image_path = [f"images_meg/cat{int(c)}/cat{int(c)}_{rng.integers(0, 12):02d}b.jpg" for c in category_nr]
+    for i in np.flatnonzero(trial_type == "test"):
+        k = rng.integers(0, n_test_images)
+        category_nr[i] = n_categories + 1 + k
+        image_path[i] = f"images_test_meg/test{k}/test{k}_01.jpg"
+    for i in np.flatnonzero(trial_type == "catch"):
+        category_nr[i] = np.nan
+        image_path[i] = "images_catch_meg/catch_01.jpg"
+    return pd.DataFrame({"trial_type": trial_type, "image_path": image_path, "category_nr": category_nr})
+
+
+def make_synthetic_bids(bids_dir, participant, n_runs, n_trials, n_channels):
+    """
+    Synthetic BIDS tree of a participant: raw runs with a trigger pulse at each trial and their events.tsv.
+
+    :return: Number of trials, and bytes of raw data.
+    """
+    rng = np.random.default_rng(0)
+    ch_names = channel_names(n_channels) + [trigger_channel]
+    info = mne.create_info(ch_names, sfreq, ["mag"] * (n_channels + 1) + ["stim"])
+    n_samples = int(sfreq * (trial_interval * (n_trials + 2)))
+    onsets = (sfreq * trial_interval * (np.arange(n_trials) + 1)).astype(int)
+    raw_bytes = 0
+    sessions = []
+    for session in range(1, n_sessions + 1):
+        meg_dir = f"{bids_dir}/sub-BIGMEG{participant}/ses-{session:02d}/meg"
+        os.makedirs(meg_dir, exist_ok=True)
+        for run in range(1, n_runs + 1):
+            data = rng.standard_normal((len(ch_names), n_samples)) * 1e-13
+            data[-1] = 0
+            data[-1, onsets] = trigger_amplitude
+            data[-1, onsets + 1] = trigger_amplitude
+            raw = mne.io.RawArray(data, info, verbose=False)
+            base = f"{meg_dir}/sub-BIGMEG{participant}_ses-{session:02d}_task-main_run-{run:02d}"
+            # fif content at the path of a CTF run (see `read_synthetic_run`)
+            raw.save(f"{base}_meg.fif", fmt="double", overwrite=True, verbose=False)
+            os.replace(f"{base}_meg.fif", f"{base}_meg.ds")
+            raw_bytes += data.nbytes
+            # optical sensor onsets are a few samples after the triggers
+            pd.DataFrame({
+                "onset": onsets / sfreq,
+                "duration": 0.5,
+                "sample": onsets + rng.integers(0, 5, n_trials),
+                "value": rng.integers(1, 30000, n_trials),
+            }).to_csv(f"{base}_events.tsv", sep="\t", index=False)
+        sessions.append(np.full(n_runs * n_trials, session))
+    attributes = trial_attributes(rng, n_sessions * n_runs * n_trials)
+    attributes["session_nr"] = np.concatenate(sessions)
+    os.makedirs(f"{bids_dir}/sourcedata", exist_ok=True)
+    attributes.to_csv(f"{bids_dir}/sourcedata/sample_attributes_P{participant}.csv", index=False)
+    return len(attributes), raw_bytes
+
+
+def make_synthetic_epochs(epochs_file, n_epochs, n_channels, n_times):
+    """
+    Synthetic preprocessed epochs with the metadata of the THINGS-MEG epochs.
+
+    :return: Number of epochs, and bytes of epoch data.
+    """
+    rng = np.random.default_rng(0)
+    info = mne.create_info(channel_names(n_channels)[:n_channels], 200., "mag")
+    metadata = trial_attributes(rng, n_epochs)
+    metadata["session_nr"] = np.repeat(np.arange(1, n_sessions + 1), n_epochs // n_sessions + 1)[:n_epochs]
+    data = rng.standard_normal((n_epochs, n_channels, n_times), dtype=np.float32)
+    events = np.c_[np.arange(n_epochs) * 300, np.zeros(n_epochs, int), np.ones(n_epochs, int)]
+    epochs = mne.EpochsArray(data, info, events, tmin=-0.1, metadata=metadata, verbose=False)
+    epochs.save(epochs_file, overwrite=True, verbose=False)
+    return n_epochs, n_epochs * n_channels * n_times * 8
+
+
+def base_config(make_type, **custom):
+    # default configuration of make.py
+    cfg = OmegaConf.merge(
+        OmegaConf.load(os.path.join(root_dir, "configs", "make.yaml")),
+        OmegaConf.load(os.path.join(root_dir, "configs", "custom", "default.yaml")),
+        {"make_type": make_type, "custom": custom},
+    )
+    cfg.pop("defaults", None)
+    return cfg
+
+
+def run_preproc(bids_dir, n_jobs):
+    cfg = base_config("custom", bids_dir=bids_dir, n_jobs=n_jobs)
+    preproc_thingsmeg(cfg, "1", logging.getLogger(__name__))
+
+
+def run_export(epochs_file, output_dir):
+    cfg = base_config("preproc")
+    preproc_data = mne.read_epochs(epochs_file, preload=False, verbose=False)
+    make_bdata_thingsmeg(cfg, "1", preproc_data, output_dir, logging.getLogger(__name__))
+
+
+def peak_rss():
+    # peak RSS (bytes) of the current process, and the largest peak RSS of its workers
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024, children
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, children
+
+
+def _run(queue, func, args):
+    t0 = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - t0
+    queue.put((elapsed,) + peak_rss())
+
+
+def run_benchmark(func, *args):
+    # run `func` in a new process and return wall time (s), peak RSS and peak RSS of the workers (bytes)
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(target=_run, args=(queue, func, args))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        raise RuntimeError(f"{func.__name__} failed (exit code {p.exitcode})")
+    return queue.get()
+
+
+def commit():
+    # current commit (with "-dirty" if the tree has changes)
+    try:
+        rev = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=root_dir, text=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD", "--", "."], cwd=root_dir) != 0
+        return rev + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results_file, base, target):
+    # time and peak RSS of `target` relative to `base` (latest result of each benchmark and scale)
+    results = pd.read_json(results_file, lines=True, dtype={"commit": str})
+    latest = results.groupby(["commit", "benchmark", "scale"]).last()
+    print(f"{'benchmark':<10} {'scale':<8} {'time ' + base:>16} {'time ' + target:>16} {'speedup':>8} {'peak RSS ratio':>15}")
+    for (benchmark, scale), row in latest.loc[target].iterrows():
+        if (base, benchmark, scale) not in latest.index:
+            continue
+        ref = latest.loc[(base, benchmark, scale)]
+        print(f"{benchmark:<10} {scale:<8} {ref.wall_s:>16.2f} {row.wall_s:>16.2f} {ref.wall_s / row.wall_s:>8.2f} {row.peak_rss / ref.peak_rss:>15.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", nargs="*", default=["small"], choices=list(scales))
+    parser.add_argument("--benchmarks", nargs="*", default=["preproc", "export"], choices=["preproc", "export"])
+    parser.add_argument("--n-jobs", type=int, default=12, help="Session workers of preproc_thingsmeg.")
+    parser.add_argument("--output", default="data/bench_results.jsonl", help="Results file (appended to; default: in the data directory, which is not tracked).")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "TARGET"), help="Compare the results of two commits and exit.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.output, *args.compare)
+        sys.exit()
+
+    rev = commit()
+    for scale in args.scales:
+        for benchmark in args.benchmarks:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                if benchmark == "preproc":
+                    n_trials, n_bytes = make_synthetic_bids(tmp_dir, "1", **scales[scale]["preproc"])
+                    t, peak, peak_workers = run_benchmark(run_preproc, tmp_dir, args.n_jobs)
+                else:
+                    epochs_file = os.path.join(tmp_dir, "synthetic-epo.fif")
+                    n_trials, n_bytes = make_synthetic_epochs(epochs_file, **scales[scale]["export"])
+                    t, peak, peak_workers = run_benchmark(run_export, epochs_file, os.path.join(tmp_dir, "output"))
+            result = {
+                "commit": rev, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "benchmark": benchmark, "scale": scale,
+                "n_trials": n_trials, "input_mb": n_bytes / 1024 ** 2, "wall_s": t,
+                "trials_per_s": n_trials / t, "mb_per_s": n_bytes / 1024 ** 2 / t,
+                "peak_rss": peak, "peak_rss_workers": peak_workers,
+            }
+            os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result) + "\n")
+            print(f"{benchmark:<8} {scale:<7} {t:>8.2f} s {n_trials / t:>10.1f} trials/s {n_bytes / 1024 ** 2 / t:>8.1f} MB/s "
+                  f"peak RSS {peak / 1024 ** 3:.2f} GiB (workers {peak_workers / 1024 ** 3:.2f} GiB)")
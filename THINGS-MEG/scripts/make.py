@@ -1,25 +1,86 @@
-from src.make_bdata_thingsmeg import make_bdata_thingsmeg
-from src.preproc_thingsmeg import preproc_thingsmeg
-import yaml
-from typing import Dict, List, Optional, Union
+from src.make_bdata_thingsmeg import make_bdata_thingsmeg, feature_definitions, split_definitions, output_file_name, storage_options
+from src.preproc_thingsmeg import preproc_thingsmeg, input_files, resolve_custom, runtime_settings
+from typing import Dict, Optional
 from functools import partial
 from glob import glob
-from itertools import product
-from pathlib import Path
 import os
 import hydra
 from omegaconf import DictConfig, OmegaConf
 import logging
-import shutil
 from src.utils.codes import save_codes
-from src.utils.record import setup_logging
+from src.utils.record import log_context, setup_logging
+from src.utils.pipeline import prefetch
+from src.utils.manifest import BuildManifest, code_version
+from src.utils import profiling
+
+
+def unit_config(cfg: DictConfig, participant: str, mode: str) -> Dict:
+    """
+    Settings which affect the output of a participant and a split.
+    
+    :param cfg: Configuration.
+    :param participant: Participant.
+    :param mode: Split.
+    
+    :return: Settings.
+    """
+    
+    config = {"make_type": cfg.make_type, "category_overlap": cfg.category_overlap, "mode": mode, "split": split_definitions(cfg)[mode]}
+    if cfg.get("output"):
+        config["output"] = OmegaConf.to_container(cfg.output, resolve=True)
+        if not config["output"].get("shard_size"): # monolithic files (same hash as before the shard settings)
+            for k in ["shard_size", "shuffle_shards", "shard_seed"]:
+                config["output"].pop(k, None)
+    if cfg.get("features"):
+        config["features"] = feature_definitions(cfg)
+    if cfg.make_type == "custom":
+        custom = OmegaConf.to_container(resolve_custom(cfg, participant), resolve=True)
+        for k in runtime_settings:
+            custom.pop(k, None)
+        config["custom"] = custom
+    return config
+
+
+
+def prepare_participant(cfg: DictConfig, participant: str, manifest: BuildManifest, code: str, output_dir: str, logger: logging.Logger, skip_up_to_date: bool = True) -> Optional[tuple]:
+    """
+    Splits to rebuild and preprocessed data of a participant.
+    
+    :param cfg: Configuration.
+    :param participant: Participant.
+    :param manifest: Build manifest.
+    :param code: Code version.
+    :param output_dir: Output directory.
+    :param logger: Logger.
+    :param skip_up_to_date: Whether to skip the splits recorded in the manifest with the same inputs (all splits are rebuilt if False).
+    
+    :return: Splits, their input hashes, and the preprocessed data, or None if the participant is up to date.
+    """
+    
+    with log_context(participant=participant):
+        modes = list(split_definitions(cfg))
+        files = input_files(cfg, participant)
+        if cfg.get("vocabulary"):
+            files.append(hydra.utils.to_absolute_path(cfg.vocabulary))
+        with profiling.span("hash_inputs", participant=participant):
+            input_hashes = {mode: manifest.input_hash(files, unit_config(cfg, participant, mode), code) for mode in modes}
+        if skip_up_to_date:
+            modes = [mode for mode in modes if not manifest.is_up_to_date(os.path.basename(output_file_name(output_dir, participant, mode, cfg)), input_hashes[mode])]
+            if not modes:
+                logger.info(f"Participant {participant} is up to date. Skip processing.")
+                return None
+            logger.info(f"Participant {participant}: rebuilding {modes}")
+        
+        with profiling.span("preprocess", participant=participant):
+            preproc_data = preproc_thingsmeg(cfg, participant, logger)
+        return modes, input_hashes, preproc_data
 
 
 
 @hydra.main(config_path="../configs", config_name="make")
 def make(cfg: DictConfig) -> None:
     
-    setup_logging()
+    setup_logging(mne_level=cfg.get("mne_log_level"))
     logger = logging.getLogger(__name__)
 
     ### Initial settings --------------------------------------------------------
@@ -38,26 +99,73 @@ def make(cfg: DictConfig) -> None:
     logger.info(f"Original cwd: {cwd}")
     logger.info(f"Hydra cwd: {hydra_cwd}")
     
+    ## check the output settings before the preprocessing
+    storage_options(cfg)
+    
     ## Check whether the output is already there 
     output_dir = os.path.join(cwd, 'data', analysis_name)
-    if os.path.exists(output_dir) and cfg.overwrite == False:
+    resume = cfg.get("resume", False)
+    if os.path.exists(output_dir) and cfg.overwrite == False and not resume:
         logger.info(f"Output directory {output_dir} already exists. Skip processing.")
         return
     
+    ## remove the temporary files of an interrupted build (outputs are renamed from them when complete)
+    for tmp_file in glob(os.path.join(output_dir, "*.tmp")):
+        logger.info(f"Removing the incomplete file {tmp_file}")
+        os.remove(tmp_file)
+    
     ## save codes for replica
     save_codes(cwd, hydra_cwd, ["src", "scripts", "configs"], logger)
     
+    ## stage profiling (trace appended to profile.jsonl, next to hydra_cwd.txt)
+    trace_file = os.path.join(output_dir, "profile.jsonl")
+    run_id = profiling.enable(trace_file, hydra_cwd) if cfg.get("profile", True) else None
+    
+    ## build manifest: the completed splits are recorded with the hash of their inputs, and skipped
+    ## if they are up to date (incremental) or if an interrupted build is continued (resume)
+    manifest = BuildManifest(output_dir, logger)
+    code = code_version(os.path.join(cwd, "src"), os.path.join(cwd, "scripts", "make.py"))
+    skip_up_to_date = bool(cfg.incremental or resume)
+    
     ### DO ---------------------------------------------------------------------
-    for participant in cfg.participants:
-        preproc_data = preproc_thingsmeg(cfg, participant, logger)
-        make_bdata_thingsmeg(cfg, participant, preproc_data, output_dir, logger)
-        
-        logger.info(f"Participant {participant} done.")
+    # The next participants (up to pipeline_depth) are preprocessed on a background
+    # thread while the current one is exported; the exports are in order.
+    # Each split is recorded in the manifest as soon as its file is complete, so that
+    # a failed build can be continued with resume=True.
+    prepare = partial(prepare_participant, cfg, manifest=manifest, code=code, output_dir=output_dir, logger=logger, skip_up_to_date=skip_up_to_date)
+    prepared_participants = prefetch(prepare, cfg.participants, cfg.get("pipeline_depth", 1), name="preprocess")
+    try:
+        for participant, prepared in zip(cfg.participants, prepared_participants):
+            if prepared is None:
+                continue
+            modes, input_hashes, preproc_data = prepared
+            prepared = None
+            
+            with log_context(participant=participant):
+                def record(mode, output_file):
+                    # the output file is the shard index of a sharded split
+                    manifest.record(os.path.basename(output_file_name(output_dir, participant, mode, cfg)), input_hashes[mode], output_file)
+                
+                with profiling.span("make_bdata", participant=participant):
+                    make_bdata_thingsmeg(cfg, participant, preproc_data, output_dir, logger, modes=modes, on_saved=record)
+                preproc_data = None
+                
+                logger.info(f"Participant {participant} done.")
+    except BaseException:
+        logger.error(f"Build interrupted. The completed splits are recorded in {manifest.path}; rerun with resume=True to continue.")
+        raise
     
     ### Save reference ----------------------------------------------------------
     # 実行時のhydraのディレクトリをoutput_dirにtxtで上書き保存
     with open(os.path.join(output_dir, "hydra_cwd.txt"), "a") as f:
         f.write(hydra_cwd + "\n")
+    
+    ### Profile summary ---------------------------------------------------------
+    if run_id is not None:
+        profiling.disable()
+        if os.path.exists(trace_file):
+            summary = profiling.summarize(profiling.read_trace(trace_file, run_id))
+            logger.info(f"Stage profile (trace: {trace_file}):\n{summary.to_string()}")
 
 
 if __name__ == "__main__":
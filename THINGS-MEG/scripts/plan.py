@@ -0,0 +1,41 @@
+from src.preproc_thingsmeg import available_memory, fit_workers, in_memory, n_workers, plan_preprocessing, resolve_custom
+from src.plan_thingsmeg import format_plan
+import os
+import tempfile
+import hydra
+from omegaconf import DictConfig
+import logging
+
+
+@hydra.main(config_path="../configs", config_name="make")
+def plan(cfg: DictConfig) -> None:
+    """
+    Log the build plan of the custom preprocessing of the participants (same settings as make.py).
+
+    Only the headers of the runs and the events.tsv files are read: the plan
+    has the output shape of each participant, the memory of the stages, and
+    the number of session workers which fit in the available memory.
+    """
+
+    logger = logging.getLogger(__name__)
+    if cfg.make_type != "custom":
+        logger.info("The build plan is made for make_type=custom.")
+        return
+
+    logger.info(f"Available memory: {available_memory() / 1024 ** 3:.1f} GiB, {os.cpu_count()} CPU cores")
+    for participant in cfg.participants:
+        custom = resolve_custom(cfg, participant)
+        participant_plan = plan_preprocessing(cfg, participant)
+        workers = fit_workers(
+            participant_plan, n_workers(custom.get("n_jobs", 12), custom.get("worker_memory_gb")), custom.get("n_threads"),
+            custom.get("run_jobs", 1), custom.get("prefetch_runs", 1), custom.get("worker_memory_gb"),
+            in_memory(hydra.utils.to_absolute_path(custom.buffer_dir) if custom.get("buffer_dir") else tempfile.gettempdir()),
+        )
+        logger.info(format_plan(participant_plan, workers))
+        if not workers["fits"]:
+            logger.warning(f"Participant {participant} does not fit in the available memory with 1 session worker.")
+
+
+if __name__ == "__main__":
+
+    plan()
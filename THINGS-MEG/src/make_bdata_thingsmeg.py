@@ -1,100 +1,445 @@
-from typing import Union
+from typing import Callable, Dict, List, Optional, Union
 
 import os
 from pathlib import Path
-import csv
 
-import bdpy
 import numpy as np
-import pandas as pd
 
 import logging
 
 import mne
 
-import yaml
-from typing import Dict, List, Optional, Union
-from functools import partial
-from glob import glob
-from itertools import product
-from pathlib import Path
-import os
 import hydra
 from omegaconf import DictConfig, OmegaConf
-import logging
-import shutil
+from contextlib import ExitStack
+
+from src.utils.bdata_utils import BDataWriter, ShardedBDataWriter, aggregate_rows, encode_labels, group_rows, load_vocabulary, shard_index_file_name, shuffle_groups
+from src.utils.profiling import span
+from src.preproc_thingsmeg import custom_suffix
+
+mode_list = ["exp", "test"] # exp is for training data, test is for test data
+
+def split_definitions(cfg: DictConfig) -> Dict[str, Dict]:
+    """
+    Output splits.
+    
+    The default splits are the training ("exp") and test data, defined by
+    `cfg.category_overlap`. Splits in `cfg.splits` are added to (or replace)
+    the default ones, and a split set to null is removed. Each split has a
+    `query` on the epoch metadata, which can refer to the categories of the
+    training and test trials as `@train_categories` and `@test_categories`,
+    and an optional `aggregate` ("mean" or "median") to aggregate the
+    repetitions of each stimulus.
+    
+    :param cfg: Configuration.
+    
+    :return: Definition of each split.
+    """
+    
+    if cfg.category_overlap:
+        splits = {mode: {"query": f"trial_type == '{mode}'"} for mode in mode_list}
+    else:
+        # remove overlap (test categories are removed from the training data, and all their trials are test data)
+        splits = {
+            "exp": {"query": "category_nr in @train_categories and category_nr not in @test_categories"},
+            "test": {"query": "category_nr in @test_categories"},
+        }
+    for name, split in OmegaConf.to_container(cfg.get("splits") or OmegaConf.create({}), resolve=True).items():
+        if split is None:
+            splits.pop(name, None)
+        else:
+            splits[name] = split
+    return splits
+
+def storage_options(cfg: DictConfig) -> Dict:
+    """
+    Storage options of the output files (dtype, HDF5 chunks and compression) from `cfg.output`.
+    
+    The dtype is float64 or float32: the stimulus numerals are stored in the
+    same dataset, and are not exactly representable in float16.
+    
+    :param cfg: Configuration.
+    
+    :return: Keyword arguments of `BDataWriter`.
+    """
+    
+    output = cfg.get("output") or {}
+    dtype = np.dtype(output.get("dtype") or "float64")
+    if dtype not in (np.float64, np.float32):
+        raise ValueError(f"Unsupported output dtype {dtype} (float64 or float32)")
+    return {
+        "dtype": dtype,
+        "chunks": output.get("chunks") or True,
+        "compression": output.get("compression"),
+        "compression_opts": output.get("compression_level"),
+        "shuffle": bool(output.get("shuffle", False)),
+    }
+
+def sharding_options(cfg: DictConfig) -> Optional[Dict]:
+    """
+    Sharding of the output files from `cfg.output` (None if `cfg.output.shard_size` is not set).
+    
+    :param cfg: Configuration.
+    
+    :return: Number of samples per shard, whether the stimuli are shuffled over the shards, and the seed of the shuffle.
+    """
+    
+    output = cfg.get("output") or {}
+    if not output.get("shard_size"):
+        return None
+    return {
+        "shard_size": int(output.shard_size),
+        "shuffle": bool(output.get("shuffle_shards", False)),
+        "seed": output.get("shard_seed", 0),
+    }
 
-def make_bdata_thingsmeg(cfg: DictConfig, participant: str, preproc_data: mne.Epochs, output_dir: Path, logger: logging.Logger) -> None:
+def open_writer(output_file: str, n_samples: int, columns: List, labels: np.ndarray, storage: Dict, sharding: Optional[Dict] = None) -> Union[BDataWriter, ShardedBDataWriter]:
+    """
+    Writer of an output file: a BDataWriter, or a ShardedBDataWriter with `sharding` (see `sharding_options`).
+    
+    :param output_file: Output file.
+    :param n_samples: Number of samples.
+    :param columns: Column groups (name, number of columns).
+    :param labels: Stimulus label of each sample (the stimuli are shuffled over the shards with `sharding["shuffle"]`).
+    :param storage: Storage options (see `storage_options`).
+    :param sharding: Sharding options (see `sharding_options`).
+    """
+    
+    if sharding is None:
+        return BDataWriter(output_file, n_samples, columns, **storage)
+    order = shuffle_groups(labels, sharding["seed"]) if sharding["shuffle"] else None
+    return ShardedBDataWriter(output_file, n_samples, columns, sharding["shard_size"], order=order, **storage)
+
+def feature_definitions(cfg: DictConfig) -> Dict[str, Dict]:
+    """
+    Feature column groups of the output files.
+    
+    Each group in `cfg.features` is a reduction of the epochs (channel x
+    time) with optional keys:
+    
+    - `channels`: channel names or name prefixes (sensor groups, e.g., "MLO"
+      for the left occipital CTF sensors; default: all channels).
+    - `tmin`, `tmax`: time range (s) of the time points (default: the epoch).
+    - `windows`: named time windows ({name: [start, end]}, s) averaged per channel.
+    - `bins`: sliding windows averaged per channel ({width, step, tmin, tmax}, s;
+      `step` defaults to `width`).
+    
+    Without `cfg.features`, the output has one "feature" group of all the
+    channels and time points.
+    
+    :param cfg: Configuration.
+    
+    :return: Definition of each feature group.
+    """
+    
+    features = OmegaConf.to_container(cfg.get("features") or OmegaConf.create({}), resolve=True)
+    for name in features:
+        if name in ("stimulus_name", "n_repetitions", "channel", "time_start", "time_end"):
+            raise ValueError(f"Feature group name {name} is reserved")
+    return {name: spec or {} for name, spec in features.items()} or {"feature": {}}
+
+def pick_channels(ch_names: List[str], picks: Optional[List[str]]) -> np.ndarray:
+    """
+    Indices of the channels whose name is one of `picks` or starts with one of them, in the order of `ch_names`.
+    """
+    
+    if picks is None:
+        return np.arange(len(ch_names))
+    picks = [picks] if isinstance(picks, str) else list(picks)
+    index = np.array([i for i, ch in enumerate(ch_names) if any(ch == p or ch.startswith(p) for p in picks)], dtype=int)
+    if len(index) == 0:
+        raise ValueError(f"No channels match {picks}")
+    return index
+
+def feature_layout(spec: Dict, ch_names: List[str], times: np.ndarray) -> Dict:
+    """
+    Columns of a feature group (see `feature_definitions`) in the epochs.
+    
+    A window [start, end) is averaged with a weight matrix (time points x
+    windows), so that all the windows of a batch of epochs are reduced with
+    one matrix product. The columns are ordered by channel, then by time
+    point or window, as the flattened epochs.
+    
+    :param spec: Definition of the feature group.
+    :param ch_names: Channel names of the epochs.
+    :param times: Time points of the epochs (s).
+    
+    :return: Channel indices ("channels"), time points read ("time" slice), weights of the windows (None for time points), and the start and end (s) of each time column ("start", "end").
+    """
+    
+    eps = 1e-6
+    channels = pick_channels(ch_names, spec.get("channels"))
+    tmin, tmax = spec.get("tmin", times[0]), spec.get("tmax", times[-1])
+    
+    windows = [tuple(w) for w in (spec.get("windows") or {}).values()]
+    bins = spec.get("bins")
+    if bins:
+        width = bins["width"]
+        step = bins.get("step", width)
+        start, stop = bins.get("tmin", tmin), bins.get("tmax", tmax)
+        windows += [(t, t + width) for t in np.arange(start, stop - width + eps, step)]
+    
+    if not windows:
+        index = np.flatnonzero((times >= tmin - eps) & (times <= tmax + eps))
+        if len(index) == 0:
+            raise ValueError(f"No time points in [{tmin}, {tmax}]")
+        time = slice(index[0], index[-1] + 1)
+        return {"channels": channels, "time": time, "weights": None, "start": times[time], "end": times[time]}
+    
+    weights = np.zeros((len(times), len(windows)))
+    for j, (start, end) in enumerate(windows):
+        in_window = (times >= start - eps) & (times < end - eps)
+        if not np.any(in_window):
+            raise ValueError(f"No time points in the window [{start}, {end})")
+        weights[in_window, j] = 1 / np.sum(in_window)
+    rows = np.flatnonzero(np.any(weights != 0, axis=1))
+    time = slice(rows[0], rows[-1] + 1)
+    return {
+        "channels": channels, "time": time, "weights": weights[time],
+        "start": np.array([w[0] for w in windows]), "end": np.array([w[1] for w in windows]),
+    }
+
+def reduce_features(data: np.ndarray, layout: Dict) -> np.ndarray:
+    """
+    Features of a batch of epochs (epochs x channels x time) in a feature group (see `feature_layout`).
+    
+    :return: Features (epochs x columns).
+    """
+    
+    channels = layout["channels"]
+    if len(channels) < data.shape[1] or layout["time"] != slice(0, data.shape[2]):
+        data = data[:, channels, layout["time"]]
+    if layout["weights"] is not None:
+        data = data @ layout["weights"]
+    return data.reshape(len(data), -1)
+
+def add_feature_metadata(writer: BDataWriter, layouts: Dict[str, Dict], ch_names: List[str]) -> None:
+    """
+    Add the channel and the time range of each feature column to an output file.
+    
+    :param writer: Output file.
+    :param layouts: Layout of each feature group (see `feature_layout`).
+    :param ch_names: Channel names of the epochs.
+    """
+    
+    description = "Channel of the feature column (0-based index in: " + ",".join(ch_names) + ")"
+    for name, layout in layouts.items():
+        n_times = len(layout["start"])
+        writer.add_metadata("channel", np.repeat(layout["channels"], n_times).astype(float), description, where=name)
+        writer.add_metadata("time_start", np.tile(layout["start"], len(layout["channels"])), "Start of the time window of the feature column (s)", where=name)
+        writer.add_metadata("time_end", np.tile(layout["end"], len(layout["channels"])), "End of the time window of the feature column (s; the time point if equal to time_start)", where=name)
+
+def output_file_name(output_dir: Path, participant: str, mode: str, cfg: Optional[DictConfig] = None) -> str:
+    """
+    Output file of a participant and a split.
+    
+    With `cfg` (make_type=custom), the file name has the settings of the
+    participant's `custom_overrides` (see `preproc_thingsmeg.custom_suffix`).
+    """
+    mode_for_save = {"exp": "train"}.get(mode, mode)
+    suffix = custom_suffix(cfg, participant) if cfg is not None and cfg.make_type == "custom" else ""
+    return os.path.join(output_dir, f"sub-0{participant}_{mode_for_save}{suffix}.h5")
+
+def make_bdata_thingsmeg(cfg: DictConfig, participant: str, preproc_data: mne.Epochs, output_dir: Path, logger: logging.Logger, modes: Optional[List[str]] = None, on_saved: Optional[Callable[[str, str], None]] = None) -> Dict[str, str]:
     """
     Make BData from preprocessed MEG data.
     
+    All single-trial splits are made in one pass over the epochs: the features
+    (channel x time) are read in batches of `cfg.batch_size` trials, and each
+    batch is written to the output file of every split it belongs to, so that
+    each epoch is read once and the selected epochs are never held in memory
+    at once. With epochs read with `preload=False`, only the epochs of a batch
+    are read from the disk.
+    
+    Splits with `aggregate` ("mean" or "median") have one row per stimulus,
+    aggregated over its repetitions, and a `n_repetitions` column. They are
+    read in batches of whole stimuli (see `write_aggregated_split`).
+    
+    With `cfg.features`, the features are reduced in each batch to the
+    feature groups of `feature_definitions` (time windows, bins, channel
+    subsets), each written as a column group with the channel and time
+    metadata of its columns.
+    
+    With `cfg.output.shard_size`, each split is written to shards of at most
+    `shard_size` trials (optionally with the stimuli shuffled over the
+    shards, `cfg.output.shuffle_shards`) and a shard index, which is the
+    output file of the split (see `ShardedBDataWriter`).
+    
+    Each output file is written to a temporary file and renamed when it is
+    complete (see `BDataWriter`), so that an interrupted export never leaves
+    a partial file, and `on_saved` is called for each completed split.
+    
     :param cfg: Configuration.
     :param participant: Participant.
     :param preproc_data: Preprocessed MEG data.
     :param output_dir: Output directory.
     :param logger: Logger.
+    :param modes: Splits to make (default: all splits in `split_definitions`).
+    :param on_saved: Function called with the split and its output file when the file is complete (e.g., to record it in the build manifest).
     
+    :return output_files: Output file of each split.
     """
     
-    mode_list = ["exp", "test"] # exp is for training data, test is for test data
+    batch_size = cfg.get("batch_size", 256)
+    layouts = {name: feature_layout(spec, preproc_data.ch_names, preproc_data.times) for name, spec in feature_definitions(cfg).items()}
+    columns = [(name, len(layout["channels"]) * len(layout["start"])) for name, layout in layouts.items()]
+    vocabulary = load_vocabulary(hydra.utils.to_absolute_path(cfg.vocabulary)) if cfg.get("vocabulary") else None
+    storage = storage_options(cfg)
+    sharding = sharding_options(cfg)
     
-    for mode in mode_list:
-        
-        # get data
-        feature_data, image_path_list = get_data(preproc_data, mode, cfg)
-        
-        # data reshape
-        feature_data = feature_data.reshape(feature_data.shape[0], -1)
-        
-        # labels list
-        label_list =[image_path.split('/')[-1].split(".")[0] for image_path in image_path_list]
-        
-        # labels index
-        unique_labels = sorted(list(set(label_list)))
-        image_index = [unique_labels.index(item)+1 for item in label_list]
-        
-        # vmap
-        vmap = dict(zip(np.arange(len(unique_labels))+1, unique_labels))
+    splits = split_definitions(cfg)
+    if modes is not None:
+        splits = {mode: splits[mode] for mode in modes}
+    
+    # get data
+    with span('partition'):
+        masks = partition_data(preproc_data, splits)
+    single_trial_masks = {mode: mask for mode, mask in masks.items() if not splits[mode].get("aggregate")}
+    epoch_index = np.flatnonzero(np.any(list(single_trial_masks.values()), axis=0)) if single_trial_masks else np.array([], dtype=int)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    output_files = {mode: output_file_name(output_dir, participant, mode, cfg) for mode in masks}
+    with span('export', modes=list(single_trial_masks)), ExitStack() as stack:
+        writers = {}
+        for mode, mask in single_trial_masks.items():
+            image_index, vmap = stimulus_labels(preproc_data, mask, vocabulary)
+            brain_data = stack.enter_context(open_writer(output_files[mode], int(np.sum(mask)), columns + [('stimulus_name', 1)], image_index, storage, sharding))
+            if cfg.get("features"):
+                add_feature_metadata(brain_data, layouts, preproc_data.ch_names)
+            brain_data.write('stimulus_name', image_index.astype(float))
+            brain_data.add_vmap("stimulus_name", vmap=vmap)
+            writers[mode] = brain_data
         
         # add data
-        brain_data = bdpy.BData()
-        brain_data.add(feature_data, 'feature')
-        brain_data.add(np.array(image_index).reshape(-1, 1).astype(int), "stimulus_name")
+        cursors = {mode: 0 for mode in single_trial_masks}
+        for start in range(0, len(epoch_index), batch_size):
+            batch = epoch_index[start:start+batch_size]
+            epoch_data = preproc_data.get_data(item=batch)
+            # feature groups (channel x time flattened)
+            feature_data = {name: reduce_features(epoch_data, layout) for name, layout in layouts.items()}
+            del epoch_data
+            for mode, mask in single_trial_masks.items():
+                batch_mask = mask[batch]
+                n = int(np.sum(batch_mask))
+                if n == 0:
+                    continue
+                for name, data in feature_data.items():
+                    writers[mode].write(name, data[batch_mask], rows=slice(cursors[mode], cursors[mode]+n))
+                cursors[mode] += n
+            del feature_data
+    
+    if sharding is not None:
+        output_files = {mode: shard_index_file_name(output_file) for mode, output_file in output_files.items()}
+    
+    def saved(mode):
+        logger.info(f"Saved {output_files[mode]}")
+        if on_saved is not None:
+            on_saved(mode, output_files[mode])
+    
+    for mode in single_trial_masks:
+        saved(mode)
+    for mode, mask in masks.items():
+        if mode not in single_trial_masks:
+            with span('aggregate', modes=[mode]):
+                write_aggregated_split(preproc_data, mask, splits[mode]["aggregate"], output_file_name(output_dir, participant, mode, cfg), batch_size, vocabulary, storage, layouts if cfg.get("features") else None, sharding)
+            saved(mode)
+    
+    return output_files
+
+
+def stimulus_labels(preproc_data: mne.Epochs, mask: np.ndarray, vocabulary: Optional[Dict[str, int]] = None) -> (np.ndarray, Dict[int, str]):
+    """
+    Stimulus labels of the selected epochs.
+    
+    :param preproc_data: Preprocessed MEG data.
+    :param mask: Mask of the selected epochs.
+    :param vocabulary: Label vocabulary (label -> index; default: labels in sorted order from 1).
+    
+    :return: Stimulus label index of each epoch, and the vmap.
+    """
+    
+    image_path_list = preproc_data.metadata['image_path'][mask].to_list()
+    
+    # labels list
+    label_list =[image_path.split('/')[-1].split(".")[0] for image_path in image_path_list]
+    
+    # labels index and vmap
+    image_index, vmap = encode_labels(label_list, vocabulary=vocabulary, start=1)
+    
+    return image_index, vmap
+
+
+def write_aggregated_split(preproc_data: mne.Epochs, mask: np.ndarray, method: str, output_file: str, batch_size: int, vocabulary: Optional[Dict[str, int]] = None, storage: Optional[Dict] = None, layouts: Optional[Dict[str, Dict]] = None, sharding: Optional[Dict] = None) -> None:
+    """
+    Write the selected epochs aggregated over the repetitions of each stimulus.
+    
+    The epochs are grouped by stimulus with a sort, and read in batches of
+    whole stimuli (about `batch_size` trials), so that the groups are
+    aggregated with `np.add.reduceat` (or a median) without holding the
+    whole split in memory. The features of each epoch are reduced to the
+    feature groups before they are aggregated.
+    
+    :param preproc_data: Preprocessed MEG data.
+    :param mask: Mask of the selected epochs.
+    :param method: "mean" or "median".
+    :param output_file: Output file.
+    :param batch_size: Number of trials read at a time.
+    :param vocabulary: Label vocabulary (see `stimulus_labels`).
+    :param storage: Storage options of the output file (see `storage_options`).
+    :param layouts: Layout of each feature group (see `feature_layout`; default: one "feature" group of all the channels and time points, without metadata).
+    :param sharding: Sharding of the output file (see `sharding_options`; default: one file).
+    """
+    
+    with_metadata = layouts is not None
+    if layouts is None:
+        layouts = {"feature": feature_layout({}, preproc_data.ch_names, preproc_data.times)}
+    columns = [(name, len(layout["channels"]) * len(layout["start"])) for name, layout in layouts.items()]
+    epoch_index = np.flatnonzero(mask)
+    image_index, vmap = stimulus_labels(preproc_data, mask, vocabulary)
+    order, starts, group_labels = group_rows(image_index)
+    ends = np.r_[starts[1:], len(order)]
+    
+    with open_writer(output_file, len(starts), columns + [('stimulus_name', 1), ('n_repetitions', 1)], group_labels, storage or {}, sharding) as brain_data:
+        if with_metadata:
+            add_feature_metadata(brain_data, layouts, preproc_data.ch_names)
+        g0 = 0
+        while g0 < len(starts):
+            g1 = max(g0 + 1, int(np.searchsorted(ends, starts[g0] + batch_size, side='right')))
+            batch = epoch_index[order[starts[g0]:ends[g1-1]]]
+            # epochs are read in the order of the file
+            read_order = np.argsort(batch)
+            epoch_data = preproc_data.get_data(item=batch[read_order])
+            for name, layout in layouts.items():
+                feature_data = np.empty((len(batch), brain_data.columns(name).stop - brain_data.columns(name).start))
+                feature_data[read_order] = reduce_features(epoch_data, layout)
+                brain_data.write(name, aggregate_rows(feature_data, starts[g0:g1] - starts[g0], method), rows=slice(g0, g1))
+                del feature_data
+            del epoch_data
+            g0 = g1
+        brain_data.write('stimulus_name', group_labels.astype(float))
+        brain_data.write('n_repetitions', (ends - starts).astype(float))
         brain_data.add_vmap("stimulus_name", vmap=vmap)
-        
-        # save
-        mode_for_save = "train" if mode == "exp" else "test"
-        os.makedirs(output_dir, exist_ok=True)
-        output_file = os.path.join(output_dir, f"sub-0{participant}_{mode_for_save}.h5")
-        brain_data.save(output_file)
-        logger.info(f"Saved {output_file}")
 
 
-def get_data(preproc_data: mne.Epochs, mode: str, cfg: DictConfig) -> (np.ndarray, List[str]) :
+def partition_data(preproc_data: mne.Epochs, splits: Dict[str, Dict]) -> Dict[str, np.ndarray]:
     """
-    Get data from preprocessed MEG data.
+    Select the epochs of each split from preprocessed MEG data.
     
     :param preproc_data: Preprocessed MEG data.
-    :param mode: Mode.
-    :param cfg: Configuration.
+    :param splits: Definition of each split (see `split_definitions`).
     
-    :return: Selected preprocessed data.
+    :return: Mask of the epochs of each split.
     """
     
-    if cfg.category_overlap:
-        feature_data = preproc_data[(preproc_data.metadata['trial_type']==mode)].get_data()
-        image_path_list = preproc_data.metadata['image_path'][(preproc_data.metadata['trial_type']==mode)].to_list()
-    else:
-        train_categories = preproc_data.metadata['category_nr'][(preproc_data.metadata['trial_type']=='exp')].to_list()
-        test_categories = preproc_data.metadata['category_nr'][(preproc_data.metadata['trial_type']=='test')].to_list()
-        
-        # remove overlap
-        categories = {}
-        categories['exp'] = list(set(train_categories) - set(test_categories))
-        categories['test'] = test_categories
-        
-        feature_data = preproc_data[(preproc_data.metadata['category_nr'].isin(categories[mode]))].get_data()
-        image_path_list = preproc_data.metadata['image_path'][(preproc_data.metadata['category_nr'].isin(categories[mode]))].to_list()
-        
-        
-    return feature_data, image_path_list
\ No newline at end of file
+    metadata = preproc_data.metadata
+    
+    # categories of the training and test trials (computed once for all splits)
+    variables = {
+        "train_categories": metadata['category_nr'][(metadata['trial_type']=='exp')].unique().tolist(),
+        "test_categories": metadata['category_nr'][(metadata['trial_type']=='test')].unique().tolist(),
+    }
+    
+    masks = {}
+    for mode, split in splits.items():
+        masks[mode] = np.asarray(metadata.eval(split["query"], local_dict=variables), dtype=bool)
+    return masks
@@ -0,0 +1,155 @@
+"""
+Build plan of the custom preprocessing from the headers of the inputs.
+
+The runs are inspected without reading their data: the channels, the
+sampling rate and the number of samples are read from the CTF (or fif)
+headers, and the number of epochs from the rows of the BIDS events.tsv
+files. The plan has the exact output shape of a participant and an
+estimate of the peak memory of each stage, which `preproc_thingsmeg` uses
+to fit the session workers in the available memory (see
+`preproc_thingsmeg.plan_preprocessing` and `preproc_thingsmeg.fit_workers`).
+"""
+
+from typing import Dict, List, Optional
+
+import mne
+import numpy as np
+import pandas as pd
+
+# channel dropped in `read_raw`
+excluded_channel = 'MRO11-1609'
+
+# memory of a worker process besides the data (Python, MNE, and the libraries)
+process_overhead = 256 * 1024 ** 2
+
+
+def inspect_run(run_path: str, event_path: str) -> Dict:
+    """
+    Header of a run.
+
+    :param run_path: CTF directory (.ds) of the run.
+    :param event_path: events.tsv file of the run.
+
+    :return: Number of channels (all and magnetometers), number of samples, sampling rate, and number of events.
+    """
+    raw = mne.io.read_raw_ctf(run_path, preload=False, verbose=False)
+    mag = [raw.ch_names[i] for i in mne.pick_types(raw.info, meg='mag')]
+    with open(event_path) as f:
+        n_events = sum(1 for line in f if line.strip()) - 1
+    return {
+        'n_channels': len(raw.ch_names) - (excluded_channel in raw.ch_names),
+        'n_mag': len(mag) - (excluded_channel in mag),
+        'n_samples': raw.n_times,
+        'sfreq': raw.info['sfreq'],
+        'n_events': n_events,
+    }
+
+
+def epoch_samples(pre_stim_time: float, post_stim_time: float, sfreq: float, output_resolution: Optional[float] = None) -> int:
+    """
+    Number of time points of an epoch (as `mne.Epochs`), decimated to `output_resolution` (as `mne.Epochs.decimate`) if given.
+    """
+    start, stop = int(round(pre_stim_time * sfreq)), int(round(post_stim_time * sfreq))
+    n_times = stop - start + 1
+    if output_resolution is None:
+        return n_times
+    decim = int(round(sfreq / output_resolution))
+    return len(range(-start % decim, n_times, decim))
+
+
+def plan_runs(participant: str, inspection: Dict[int, List[Dict]], pre_stim_time: float, post_stim_time: float,
+              output_resolution: float, dtype: type = np.float64, batch_size: int = 256) -> Dict:
+    """
+    Output shape and memory of the stages of the custom preprocessing of a participant.
+
+    The memory of a stage is the data it holds at its peak (float64 unless
+    stated): `read_raw` a raw run (all channels), `filter` the buffers of a
+    filter thread, `epoch` the epochs of a run, `session` the epochs of a
+    session and its decimated copy, and `stack` the output array (`dtype`).
+    The epochs dropped by MNE (out of the run) are counted, so that the
+    number of epochs is an upper bound.
+
+    :param participant: Participant.
+    :param inspection: Headers of the runs of each session (see `inspect_run`).
+    :param pre_stim_time: Start of the epochs (s).
+    :param post_stim_time: End of the epochs (s).
+    :param output_resolution: Sampling rate of the output (Hz).
+    :param dtype: dtype of the decimated sessions and the output array.
+    :param batch_size: Number of epochs read at a time in the export.
+
+    :return: Plan (see `worker_memory` and `format_plan`).
+    """
+    runs = [run for session_runs in inspection.values() for run in session_runs]
+    if not runs:
+        raise FileNotFoundError(f'No runs of participant {participant}')
+
+    sfreq = runs[0]['sfreq']
+    n_mag = runs[0]['n_mag']
+    n_times = epoch_samples(pre_stim_time, post_stim_time, sfreq)
+    n_times_out = epoch_samples(pre_stim_time, post_stim_time, sfreq, output_resolution)
+    itemsize = np.dtype(dtype).itemsize
+    n_epochs = sum(run['n_events'] for run in runs)
+    n_session_epochs = max(sum(run['n_events'] for run in session_runs) for session_runs in inspection.values())
+
+    stages = {
+        'read_raw': max(run['n_channels'] * run['n_samples'] for run in runs) * 8,
+        # padded signal and its FFT of a channel in each filter thread
+        'filter': max(run['n_samples'] for run in runs) * 8 * 4,
+        'epoch': max(run['n_events'] for run in runs) * n_mag * n_times * 8,
+        'session': n_session_epochs * n_mag * (n_times * 8 + n_times_out * itemsize),
+        'stack': n_epochs * n_mag * n_times_out * itemsize,
+        'export': batch_size * n_mag * n_times_out * 8 * 2,
+    }
+    return {
+        'participant': participant,
+        'n_runs': {session: len(session_runs) for session, session_runs in inspection.items()},
+        'n_epochs': n_epochs,
+        'n_channels': n_mag,
+        'n_times': n_times_out,
+        'sfreq': sfreq,
+        'output_shape': (n_epochs, n_mag * n_times_out),
+        'stages': stages,
+    }
+
+
+def worker_memory(plan: Dict, run_jobs: int = 1, filter_jobs: int = 1, prefetch_runs: int = 1) -> int:
+    """
+    Peak memory of a session worker (bytes).
+
+    A worker holds the runs being filtered and read ahead, the filter
+    buffers and the epochs of the concurrent runs, and the session.
+
+    :param plan: Plan (see `plan_runs`).
+    :param run_jobs: Number of runs filtered concurrently.
+    :param filter_jobs: Number of filter threads of a run.
+    :param prefetch_runs: Number of runs read ahead.
+    """
+    stages = plan['stages']
+    return int(
+        process_overhead
+        + (run_jobs + max(0, prefetch_runs)) * stages['read_raw']
+        + run_jobs * (filter_jobs * stages['filter'] + stages['epoch'])
+        + stages['session']
+    )
+
+
+def format_plan(plan: Dict, workers: Optional[Dict] = None) -> str:
+    """
+    Plan as text (for the logs).
+
+    :param plan: Plan (see `plan_runs`).
+    :param workers: Workers (see `preproc_thingsmeg.fit_workers`).
+    """
+    gib = 1024 ** 3
+    lines = [
+        f"Participant {plan['participant']}: up to {plan['n_epochs']} epochs x {plan['n_channels']} channels x {plan['n_times']} time points "
+        f"(output up to {plan['output_shape'][0]} x {plan['output_shape'][1]}), {sum(plan['n_runs'].values())} runs in {len(plan['n_runs'])} sessions",
+    ]
+    stages = pd.Series(plan['stages']) / gib
+    lines.append("Memory of the stages (GiB):\n" + stages.round(3).to_string())
+    if workers is not None:
+        lines.append(
+            f"Session workers: {workers['n_jobs']} x {workers['worker_memory'] / gib:.2f} GiB ({workers['run_jobs']} runs at a time, "
+            f"{workers['filter_jobs']} filter threads per run), peak {workers['peak_memory'] / gib:.2f} GiB of {workers['available_memory'] / gib:.2f} GiB available"
+        )
+    return "\n".join(lines)
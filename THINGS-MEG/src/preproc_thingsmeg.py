@@ -34,7 +34,7 @@
 import mne, os
 import numpy as np
 import pandas as pd 
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, parallel_config
 
 import yaml
 from typing import Dict, List, Optional, Union
@@ -47,6 +47,14 @@ import hydra
 from omegaconf import DictConfig, OmegaConf
 import logging
 import shutil
+import tempfile
+
+from src.utils.bdata_utils import available_memory
+from src.utils.stage_cache import StageCache, source_identity
+from src.utils.profiling import span
+from src.utils.record import log_context, worker_initializer
+from src.utils.pipeline import ordered_map, prefetch
+from src.plan_thingsmeg import format_plan, inspect_run, plan_runs, worker_memory
 
 #*****************************#
 ### SET UP HYPERPARAMETERS ###
@@ -94,26 +102,80 @@ def read_events(event_paths,run,raw):
     events[:,2] = event_file['value']
     return events
 
-def concat_epochs(raw, events, epochs, pre_stim_time, post_stim_time):
-    if epochs:
-        epochs_1 = mne.Epochs(raw, events, tmin = pre_stim_time, tmax = post_stim_time, picks = 'mag',baseline=None)
-        epochs_1.info['dev_head_t'] = epochs.info['dev_head_t']
-        epochs = mne.concatenate_epochs([epochs,epochs_1])
+def filter_raw(raw, l_freq, h_freq, n_threads=1):
+    # band-pass filter, with the channels filtered on `n_threads` threads
+    if n_threads > 1:
+        with parallel_config(backend='threading', n_jobs=n_threads):
+            raw.filter(l_freq=l_freq,h_freq=h_freq,n_jobs=n_threads)
     else:
-        epochs = mne.Epochs(raw, events, tmin = pre_stim_time, tmax = post_stim_time, picks = 'mag',baseline=None)
-    return epochs
+        raw.filter(l_freq=l_freq,h_freq=h_freq)
+    return raw
+
+def count_events(event_paths):
+    # number of events in the event files (upper bound of the number of epochs)
+    return sum(len(pd.read_csv(event_path,sep='\t')) for event_path in event_paths)
+
+def epoch_run(raw, events, pre_stim_time, post_stim_time):
+    # preloaded epochs of a run (epochs out of the run are dropped on loading)
+    return mne.Epochs(raw, events, tmin = pre_stim_time, tmax = post_stim_time, picks = 'mag',baseline=None,preload=True)
 
-def baseline_correction(epochs):
-    baselined_epochs = mne.baseline.rescale(data=epochs.get_data(),times=epochs.times,baseline=(None,0),mode='zscore',copy=False)
-    epochs = mne.EpochsArray(baselined_epochs, epochs.info, epochs.events, epochs.tmin,event_id=epochs.event_id)
+def offset_events(events, offset, tmax, sfreq):
+    # event samples shifted as in mne.concatenate_epochs(add_offset=True)
+    events = events.copy()
+    if len(events) == 0:
+        return events, offset
+    max_timestamp = int(np.max(events[:,0]))
+    events[:,0] += offset
+    return events, offset + max_timestamp + np.int64((10 + tmax) * sfreq)
+
+def assemble_session(run_epochs, n_epochs_max):
+    # Concatenate the epochs of the runs into one preallocated array, and apply
+    # the zscore baseline in place. `run_epochs` is an iterable of the epochs of
+    # the runs, so that each run is released once it has been copied.
+    data, info, events, event_id = None, None, [], {}
+    n_epochs, offset = 0, np.int64(0)
+    for epochs in run_epochs:
+        if data is None:
+            info, times, tmin, tmax = epochs.info, epochs.times, epochs.tmin, epochs.tmax
+            data = np.empty((n_epochs_max, len(epochs.ch_names), len(times)))
+        run_data = epochs.get_data(copy=False)
+        data[n_epochs:n_epochs+len(run_data)] = run_data
+        n_epochs += len(run_data)
+        run_events, offset = offset_events(epochs.events, offset, tmax, info['sfreq'])
+        events.append(run_events)
+        event_id.update(epochs.event_id)
+        del epochs, run_data
+    data = data[:n_epochs]
+    with span('baseline'):
+        mne.baseline.rescale(data=data,times=times,baseline=(None,0),mode='zscore',copy=False)
+        epochs = mne.EpochsArray(data, info, np.concatenate(events), tmin,event_id=event_id)
     return epochs
 
-def stack_sessions(sourcedata_dir,preproc_dir,participant,session_epochs,output_resolution, ):
-    for epochs in session_epochs:
-        epochs.info['dev_head_t'] = session_epochs[0].info['dev_head_t']
-    all_epochs = mne.concatenate_epochs(epochs_list = session_epochs, add_offset=True,)
+def stack_sessions(sourcedata_dir,preproc_dir,participant,session_results,n_epochs_max,dtype=np.float64):
+    # Copy the (decimated) sessions into one preallocated array. The data of each
+    # session are read from the file written by its worker (see
+    # `preprocess_session`) and the file is removed once it has been copied.
+    data, events, event_id = None, [], {}
+    n_epochs, offset = 0, np.int64(0)
+    for i in range(len(session_results)):
+        session = session_results[i]
+        session_results[i] = None
+        session_data = np.load(session['data_file'], mmap_mode='r')
+        if data is None:
+            info, tmin, tmax, sfreq = session['info'], session['tmin'], session['tmax'], session['sfreq']
+            data = np.empty((n_epochs_max,) + session_data.shape[1:], dtype=dtype)
+        data[n_epochs:n_epochs+len(session_data)] = session_data
+        n_epochs += len(session_data)
+        del session_data
+        os.remove(session['data_file'])
+        # event samples are offset at the sampling rate before the decimation
+        session_events, offset = offset_events(session['events'], offset, tmax, sfreq)
+        events.append(session_events)
+        event_id.update(session['event_id'])
+        del session
+    all_epochs = mne.EpochsArray(data[:n_epochs], info, np.concatenate(events), tmin, event_id=event_id)
+    del data
     all_epochs.metadata = pd.read_csv(f'{sourcedata_dir}/sample_attributes_P{str(participant)}.csv')
-    all_epochs.decimate(decim=(1200/output_resolution))
     # all_epochs.save(f'{preproc_dir}/preprocessed_P{str(participant)}-epo.fif', overwrite=True)
     print(all_epochs.info)
     
@@ -123,23 +185,276 @@ def stack_sessions(sourcedata_dir,preproc_dir,participant,session_epochs,output_
 #*****************************#
 ### FUNCTION TO RUN PREPROCESSING ###
 #*****************************#
-def run_preprocessing(meg_dir,session,participant, l_freq, h_freq, pre_stim_time, post_stim_time):
-    epochs = []
+def run_preprocessing(meg_dir,session,participant, l_freq, h_freq, pre_stim_time, post_stim_time, cache=None, run_jobs=1, filter_jobs=1, prefetch_runs=1):
+    # Epoched and baselined session (reused when only the output resolution changes).
+    # The runs are read on a background thread up to `prefetch_runs` runs ahead,
+    # `run_jobs` runs are filtered and epoched concurrently on threads, and the
+    # channels of each run are filtered on `filter_jobs` threads.
+    # The cache keys include the source files (path, size and mtime), so that the
+    # entries of another BIDS directory or of changed runs are never reused.
     run_paths, event_paths = setup_paths(meg_dir, session)
-    for run, curr_path in enumerate(run_paths):
-        raw = read_raw(curr_path,session,run, participant)
-        events = read_events(event_paths,run,raw)
-        raw.filter(l_freq=l_freq,h_freq=h_freq)
-        epochs = concat_epochs(raw, events, epochs, pre_stim_time, post_stim_time)
-        epochs.drop_bad()
+    
+    if cache is not None:
+        epochs_key = cache.key('epochs', participant=participant, session=session, l_freq=l_freq, h_freq=h_freq, pre_stim_time=pre_stim_time, post_stim_time=post_stim_time,
+                               meg_dir=os.path.abspath(meg_dir), runs=[source_identity(path) for path in run_paths], events=[source_identity(path) for path in event_paths])
+        with span('cache_load', cache_stage='epochs'):
+            epochs = cache.load(epochs_key, lambda d: mne.read_epochs(f'{d}/session-epo.fif', preload=True))
+        if epochs is not None:
+            return epochs
+    
+    def raw_key(run):
+        return cache.key('filtered', participant=participant, session=session, run=run, l_freq=l_freq, h_freq=h_freq,
+                         meg_dir=os.path.abspath(meg_dir), source=source_identity(run_paths[run]))
+    
+    def load_run(run):
+        # raw run, or filtered run if it is in the cache (reused when only the epoching changes)
+        with log_context(participant=participant, session=session, run=run):
+            if cache is not None:
+                with span('cache_load', participant=participant, session=session, run=run, cache_stage='filtered'):
+                    raw = cache.load(raw_key(run), lambda d: mne.io.read_raw_fif(f'{d}/run-raw.fif', preload=True))
+                if raw is not None:
+                    return run, raw, True
+            with span('read_raw', participant=participant, session=session, run=run):
+                return run, read_raw(run_paths[run],session,run, participant), False
+    
+    def process_run(loaded):
+        run, raw, filtered = loaded
+        with log_context(participant=participant, session=session, run=run), span('run', participant=participant, session=session, run=run):
+            if not filtered:
+                with span('filter'):
+                    filter_raw(raw, l_freq, h_freq, filter_jobs)
+                if cache is not None:
+                    with span('cache_save', cache_stage='filtered'):
+                        cache.save(raw_key(run), lambda d: raw.save(f'{d}/run-raw.fif', fmt='double'))
+            with span('epoch'):
+                events = read_events(event_paths,run,raw)
+                return epoch_run(raw, events, pre_stim_time, post_stim_time)
+    
+    def iter_run_epochs():
+        dev_head_t = None
+        runs = prefetch(load_run, range(len(run_paths)), prefetch_runs, name=f'prefetch-session-{session}')
+        for epochs in ordered_map(process_run, runs, run_jobs):
+            # head position of the first run is used for the session
+            if dev_head_t is None:
+                dev_head_t = epochs.info['dev_head_t']
+            epochs.info['dev_head_t'] = dev_head_t
+            yield epochs
+    
+    epochs = assemble_session(iter_run_epochs(), count_events(event_paths))
     print(epochs.info)
-    epochs = baseline_correction(epochs)
+    
+    if cache is not None:
+        with span('cache_save', cache_stage='epochs'):
+            cache.save(epochs_key, lambda d: epochs.save(f'{d}/session-epo.fif', fmt='double'))
     return epochs
 
 
+def preprocess_session(meg_dir,session,participant, l_freq, h_freq, pre_stim_time, post_stim_time, output_resolution, buffer_dir, dtype=np.float64, cache=None, run_jobs=1, filter_jobs=1, prefetch_runs=1):
+    # Preprocessed session decimated to the output resolution in the worker. The
+    # data are written to a file in `buffer_dir`, which the parent process maps
+    # into memory, so that only the events and the info are pickled back.
+    with log_context(participant=participant, session=session), span('session', participant=participant, session=session):
+        epochs = run_preprocessing(meg_dir,session,participant, l_freq, h_freq, pre_stim_time, post_stim_time, cache, run_jobs, filter_jobs, prefetch_runs)
+        tmax, sfreq = epochs.tmax, epochs.info['sfreq']
+        with span('decimate'):
+            epochs.decimate(decim=(sfreq/output_resolution))
+        data_file = os.path.join(buffer_dir, f'session-{str(session).zfill(2)}.npy')
+        with span('save'):
+            np.save(data_file, epochs.get_data(copy=False).astype(dtype, copy=False))
+    return {
+        'data_file': data_file,
+        'events': epochs.events,
+        'event_id': epochs.event_id,
+        'info': epochs.info,
+        'tmin': epochs.tmin,
+        'tmax': tmax,
+        'sfreq': sfreq,
+    }
+
+
+#*****************************#
+### FUNCTIONS TO RESOLVE INPUTS ###
+#*****************************#
+preproc_epochs_dir = "src/MEG-preprocessed-dataset/LOCAL/ocontier/thingsmri/openneuro/THINGS-data/THINGS-MEG/ds004212/derivatives/preprocessed"
+
+# custom settings which do not change the output (the source files are hashed by their content)
+runtime_settings = ("bids_dir", "cache_dir", "cache_max_size_gb", "n_jobs", "worker_memory_gb", "buffer_dir", "n_threads", "run_jobs", "prefetch_runs", "memory_check")
+
+def resolve_custom(cfg: DictConfig, participant: str) -> DictConfig:
+    """
+    Resolve the custom preprocessing settings of a participant.
+    
+    Settings in `custom_overrides[participant]` override `custom`. The
+    participant is looked up as an int and as a str, since the keys set on
+    the command line (e.g., `+custom_overrides.2.l_freq=0.5`) are strings.
+    
+    :param cfg: Configuration.
+    :param participant: Participant.
+    
+    :return custom: Custom preprocessing settings.
+    """
+    
+    overrides = cfg.get("custom_overrides", None) or {}
+    settings = [overrides[key] for key in dict.fromkeys([participant, str(participant)]) if key in overrides]
+    if settings:
+        return OmegaConf.merge(cfg.custom, *settings)
+    return cfg.custom
+
+def custom_suffix(cfg: DictConfig, participant: str) -> str:
+    """
+    Suffix of the output files of a participant whose `custom_overrides` change the output.
+    
+    The output directory is named from the `custom` settings, so the
+    settings of a participant which differ from them are added to the file
+    names (e.g., "_l_freq-0.5"), and the files of the participant with and
+    without the overrides are not mixed up.
+    
+    :param cfg: Configuration.
+    :param participant: Participant.
+    
+    :return: Suffix ("" without overrides of the output settings).
+    """
+    
+    default = OmegaConf.to_container(cfg.custom, resolve=True)
+    custom = OmegaConf.to_container(resolve_custom(cfg, participant), resolve=True)
+    changed = sorted(k for k, v in custom.items() if k not in runtime_settings and default.get(k) != v)
+    return "".join(f"_{k}-{custom[k]}" for k in changed)
+
+def input_files(cfg: DictConfig, participant: str) -> List[str]:
+    """
+    List the source files of a participant.
+    
+    :param cfg: Configuration.
+    :param participant: Participant.
+    
+    :return: Source files (CTF runs are directories).
+    """
+    
+    if cfg.make_type == "preproc":
+        # Large epochs files are split into preprocessed_P{participant}-epo-1.fif, ...
+        return sorted(glob(hydra.utils.to_absolute_path(f"{preproc_epochs_dir}/preprocessed_P{participant}-epo*.fif")))
+    
+    bids_dir = resolve_custom(cfg, participant).bids_dir
+    meg_dir = f'{bids_dir}/sub-BIGMEG{participant}/'
+    files = [f'{bids_dir}/sourcedata/sample_attributes_P{str(participant)}.csv']
+    for session in range(1, n_sessions+1):
+        run_paths, event_paths = setup_paths(meg_dir, session)
+        files += run_paths + event_paths
+    return files
+
+
 #*****************************#
 ### FUNCTION TO PREPROCESS THINGS-MEG DATA ###
 #*****************************#
+def n_workers(n_jobs: Union[int, str], worker_memory_gb: Optional[float] = None, n_tasks: int = n_sessions) -> int:
+    """
+    Number of session workers.
+    
+    :param n_jobs: Number of workers, or "auto" to fit the workers in the CPU cores and the available memory.
+    :param worker_memory_gb: Peak memory of a worker (GB), used with "auto" (if None, the workers are fitted in the memory with the build plan, see `fit_workers`).
+    :param n_tasks: Number of sessions.
+    
+    :return: Number of workers.
+    """
+    if n_jobs != 'auto':
+        return int(n_jobs)
+    n_memory = int(available_memory() // (worker_memory_gb * 1024 ** 3)) if worker_memory_gb else n_tasks
+    return max(1, min(n_tasks, os.cpu_count() or 1, n_memory))
+
+
+def thread_budget(n_threads: Optional[int], n_jobs: int, run_jobs: int = 1) -> (int, int):
+    """
+    Threads of a session worker.
+    
+    The threads of the budget are shared by the session workers, and the
+    threads of a worker by the runs processed concurrently, so that the two
+    levels do not use more than `n_threads` threads in total.
+    
+    :param n_threads: Total number of threads (default: CPU cores).
+    :param n_jobs: Number of session workers.
+    :param run_jobs: Maximum number of runs read and filtered concurrently in a worker.
+    
+    :return: Number of runs processed concurrently, and number of filter threads of each run.
+    """
+    n_threads = int(n_threads or os.cpu_count() or 1)
+    session_threads = max(1, n_threads // n_jobs)
+    run_jobs = max(1, min(int(run_jobs), session_threads))
+    return run_jobs, max(1, session_threads // run_jobs)
+
+
+def plan_preprocessing(cfg: DictConfig, participant: str) -> Dict:
+    """
+    Build plan of the custom preprocessing of a participant, from the headers of its runs (see `plan_thingsmeg`).
+    
+    :param cfg: Configuration.
+    :param participant: Participant.
+    
+    :return: Plan (see `plan_thingsmeg.plan_runs`).
+    """
+    custom = resolve_custom(cfg, participant)
+    meg_dir = f'{custom.bids_dir}/sub-BIGMEG{participant}/'
+    inspection = {}
+    for session in range(1, n_sessions+1):
+        run_paths, event_paths = setup_paths(meg_dir, session)
+        inspection[session] = [inspect_run(run_path, event_path) for run_path, event_path in zip(run_paths, event_paths)]
+    return plan_runs(
+        participant, inspection, custom.pre_stim_time, custom.post_stim_time, custom.output_resolution,
+        np.dtype(custom.get('dtype') or 'float64'), cfg.get('batch_size', 256),
+    )
+
+
+def in_memory(path: str) -> bool:
+    """
+    Whether `path` is on a file system in memory (tmpfs, e.g., /dev/shm).
+    """
+    path, fs_type, mount_len = os.path.realpath(path), None, -1
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                mount_point, mount_type = line.split()[1:3]
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > mount_len:
+                    fs_type, mount_len = mount_type, len(mount_point)
+    except OSError:
+        pass
+    return fs_type in ('tmpfs', 'ramfs')
+
+
+def fit_workers(plan: Dict, n_jobs: int, n_threads: Optional[int] = None, run_jobs: int = 1, prefetch_runs: int = 1,
+                worker_memory_gb: Optional[float] = None, buffer_in_memory: bool = False, available: Optional[int] = None, reduce: bool = True) -> Dict:
+    """
+    Largest number of session workers, up to `n_jobs`, whose memory fits in the available memory.
+    
+    The sessions are stacked after the workers have exited, so that the peak
+    memory is the larger of the memory of the workers and the output array.
+    With the session buffers in memory (see `in_memory`), the decimated
+    sessions are added to both.
+    
+    :param plan: Build plan (see `plan_preprocessing`).
+    :param n_jobs: Requested number of workers.
+    :param n_threads: Total number of threads (see `thread_budget`).
+    :param run_jobs: Requested number of runs filtered concurrently in a worker.
+    :param prefetch_runs: Number of runs read ahead in a worker.
+    :param worker_memory_gb: Peak memory of a worker (GB; estimated from the plan if None, see `plan_thingsmeg.worker_memory`).
+    :param buffer_in_memory: Whether the session buffers are in memory.
+    :param available: Available memory (bytes; see `available_memory` if None).
+    :param reduce: Whether to reduce the number of workers (if False, the memory of `n_jobs` workers is returned).
+    
+    :return: Number of workers ("n_jobs"), their threads ("run_jobs", "filter_jobs"), the memory of a worker, the peak memory and the available memory (bytes), and whether the peak fits in the available memory ("fits").
+    """
+    available = available_memory() if available is None else available
+    buffers = plan['stages']['stack'] if buffer_in_memory else 0
+    for n in range(max(1, int(n_jobs)), 0, -1):
+        n_run_jobs, filter_jobs = thread_budget(n_threads, n, run_jobs)
+        worker = int(worker_memory_gb * 1024 ** 3) if worker_memory_gb else worker_memory(plan, n_run_jobs, filter_jobs, prefetch_runs)
+        peak = max(n * worker, plan['stages']['stack']) + buffers
+        if peak <= available or not reduce:
+            break
+    return {
+        'n_jobs': n, 'run_jobs': n_run_jobs, 'filter_jobs': filter_jobs,
+        'worker_memory': worker, 'peak_memory': peak, 'available_memory': available, 'fits': peak <= available,
+    }
+
+
 def preproc_thingsmeg(cfg: DictConfig, participant: str, logger: logging.Logger) -> mne.Epochs:
     """
     Preprocess THINGS-MEG data.
@@ -153,25 +468,59 @@ def preproc_thingsmeg(cfg: DictConfig, participant: str, logger: logging.Logger)
     """
 
     if cfg.make_type == "preproc":
-        file_name = f"src/MEG-preprocessed-dataset/LOCAL/ocontier/thingsmri/openneuro/THINGS-data/THINGS-MEG/ds004212/derivatives/preprocessed/preprocessed_P{participant}-epo.fif"
-        preproc_data = mne.read_epochs(file_name)
+        file_name = hydra.utils.to_absolute_path(f"{preproc_epochs_dir}/preprocessed_P{participant}-epo.fif")
+        # epochs are read from the disk when they are exported (see make_bdata_thingsmeg)
+        with span('read_epochs'):
+            preproc_data = mne.read_epochs(file_name, preload=False)
         return preproc_data
     
+    custom                      = resolve_custom(cfg, participant)
+    
     ##### Set up paths #####
-    bids_dir                    = cfg.custom.bids_dir
+    bids_dir                    = custom.bids_dir
     meg_dir                     = f'{bids_dir}/sub-BIGMEG{participant}/'
     sourcedata_dir              = f'{bids_dir}/sourcedata/'
     preproc_dir                 = f'{bids_dir}/derivatives/preprocessed/'
     
     ##### Set up hyperparameters #####
-    l_freq                      = cfg.custom.l_freq
-    h_freq                      = cfg.custom.h_freq
-    pre_stim_time               = cfg.custom.pre_stim_time
-    post_stim_time              = cfg.custom.post_stim_time
-    output_resolution           = cfg.custom.output_resolution
+    l_freq                      = custom.l_freq
+    h_freq                      = custom.h_freq
+    pre_stim_time               = custom.pre_stim_time
+    post_stim_time              = custom.post_stim_time
+    output_resolution           = custom.output_resolution
+    dtype                       = np.dtype(custom.get('dtype') or 'float64')
+    
+    ##### Set up cache #####
+    # relative to the original working directory (hydra changes it to the run directory)
+    cache = StageCache(hydra.utils.to_absolute_path(custom.cache_dir), custom.cache_max_size_gb, logger) if custom.get('cache_dir') else None
+    buffer_root = hydra.utils.to_absolute_path(custom.buffer_dir) if custom.get('buffer_dir') else None
+    if buffer_root is not None:
+        os.makedirs(buffer_root, exist_ok=True)
 
     ####### Run preprocessing ########
-    session_epochs = Parallel(n_jobs=12, backend="multiprocessing")(delayed(run_preprocessing)(meg_dir,session,participant, l_freq, h_freq, pre_stim_time, post_stim_time) for session in range(1,n_sessions+1))
-    preproc_data = stack_sessions(sourcedata_dir,preproc_dir,participant,session_epochs,output_resolution)
+    # the output is preallocated and the workers are fitted in the memory with the build plan
+    with span('plan'):
+        plan = plan_preprocessing(cfg, participant)
+    n_jobs = n_workers(custom.get('n_jobs', 12), custom.get('worker_memory_gb'))
+    memory_check = custom.get('memory_check', 'reduce')
+    buffer_in_memory = in_memory(buffer_root or tempfile.gettempdir())
+    workers = fit_workers(plan, n_jobs, custom.get('n_threads'), custom.get('run_jobs', 1), custom.get('prefetch_runs', 1), custom.get('worker_memory_gb'), buffer_in_memory, reduce=memory_check == 'reduce')
+    logger.info(format_plan(plan, workers))
+    if memory_check != 'off' and not workers['fits']:
+        raise MemoryError(
+            f"Preprocessing participant {participant} with {n_jobs} workers would exceed the available memory "
+            f"({workers['available_memory'] / 1024 ** 3:.1f} GiB); reduce custom.n_jobs or custom.run_jobs, or use custom.dtype=float32 "
+            f"(custom.memory_check=reduce fits the workers, and custom.memory_check=off disables the check)"
+        )
+    if workers['n_jobs'] < n_jobs:
+        logger.warning(f"Reduced the session workers from {n_jobs} to {workers['n_jobs']} to fit the available memory")
+    n_jobs, run_jobs, filter_jobs = workers['n_jobs'], workers['run_jobs'], workers['filter_jobs']
+    logger.info(f"Preprocessing {n_sessions} sessions with {n_jobs} workers")
+    logger.info(f"Session workers: {run_jobs} runs at a time, {filter_jobs} filter threads per run")
+    n_epochs_max = plan['n_epochs']
+    with tempfile.TemporaryDirectory(prefix='thingsmeg-', dir=buffer_root) as buffer_dir:
+        session_results = Parallel(n_jobs=n_jobs, backend="multiprocessing", **worker_initializer())(delayed(preprocess_session)(meg_dir,session,participant, l_freq, h_freq, pre_stim_time, post_stim_time, output_resolution, buffer_dir, dtype, cache, run_jobs, filter_jobs, custom.get('prefetch_runs', 1)) for session in range(1,n_sessions+1))
+        with span('stack'):
+            preproc_data = stack_sessions(sourcedata_dir,preproc_dir,participant,session_results,n_epochs_max,dtype)
     
     return preproc_data
\ No newline at end of file
@@ -0,0 +1 @@
+../../../THINGS-fMRI/bdata_utils.py
\ No newline at end of file
@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from glob import glob
+from typing import Dict, List, Optional
+
+
+class BuildManifest:
+    """
+    Manifest of the outputs in an output directory, used to rebuild only stale outputs.
+
+    Each output (unit) is recorded with the hash of its inputs: the content of
+    the source files, the resolved configuration, and the code version. The
+    content hash of a file is reused while its size and mtime are unchanged,
+    so that large source files are hashed only once.
+
+    A unit is recorded once its output file is complete, and the manifest is
+    saved at each record by writing a temporary file and renaming it, so that
+    an interrupted build leaves a valid manifest of the completed units.
+    """
+
+    file_name = "manifest.json"
+
+    def __init__(self, output_dir: str, logger: Optional[logging.Logger] = None):
+        self.path = os.path.join(output_dir, self.file_name)
+        self.logger = logger or logging.getLogger(__name__)
+        self.files = {}
+        self.units = {}
+        # the inputs of a participant are hashed while another one is recorded (see make.py)
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+            self.files = manifest.get("files", {})
+            self.units = manifest.get("units", {})
+
+    def file_hash(self, path: str) -> str:
+        """
+        Content hash of a file, or of all files in a directory (e.g., CTF .ds).
+
+        :param path: File or directory.
+
+        :return: Hex digest.
+        """
+        if os.path.isdir(path):
+            h = hashlib.sha256()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    h.update(os.path.relpath(file_path, path).encode())
+                    h.update(self.file_hash(file_path).encode())
+            return h.hexdigest()
+
+        key = os.path.abspath(path)
+        st = os.stat(path)
+        entry = self.files.get(key)
+        if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry["sha256"]
+
+        self.logger.info(f"Hashing {path}")
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        with self._lock:
+            self.files[key] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": h.hexdigest()}
+        return h.hexdigest()
+
+    def input_hash(self, input_files: List[str], config: Dict, code_version: str) -> str:
+        """
+        Hash of the inputs of a unit.
+
+        :param input_files: Source files.
+        :param config: Configuration which affects the output.
+        :param code_version: Code version (see `code_version`).
+
+        :return: Hex digest.
+        """
+        inputs = {
+            "files": {os.path.abspath(p): self.file_hash(p) for p in sorted(input_files)},
+            "config": config,
+            "code": code_version,
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def is_up_to_date(self, unit: str, input_hash: str) -> bool:
+        """
+        Whether the output of `unit` exists and was built from the same inputs.
+        """
+        entry = self.units.get(unit)
+        return entry is not None and entry["hash"] == input_hash and os.path.exists(entry["output"])
+
+    def record(self, unit: str, input_hash: str, output_file: str) -> None:
+        """
+        Record a built unit and save the manifest.
+        """
+        with self._lock:
+            self.units[unit] = {"hash": input_hash, "output": output_file}
+        self.save()
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            manifest = json.dumps({"files": self.files, "units": self.units}, indent=2, sort_keys=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(manifest)
+            os.replace(tmp_path, self.path)
+
+
+def code_version(*code_paths: str) -> str:
+    """
+    Hash of the Python sources in `code_paths`.
+
+    :param code_paths: Code directories (e.g., src) and files (e.g., scripts/make.py, which defines the settings of the outputs).
+
+    :return: Hex digest.
+    """
+    h = hashlib.sha256()
+    for code_path in code_paths:
+        if os.path.isdir(code_path):
+            paths = sorted(glob(os.path.join(code_path, "**", "*.py"), recursive=True))
+        else:
+            paths = [code_path]
+        base_dir = os.path.dirname(os.path.abspath(code_path))
+        for path in paths:
+            h.update(os.path.relpath(os.path.abspath(path), base_dir).encode())
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
@@ -0,0 +1,84 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator
+
+
+def ordered_map(func: Callable, items: Iterable, n_threads: int = 1) -> Iterator[Any]:
+    """
+    Results of `func` on the items in order, computed on `n_threads` threads.
+
+    At most `n_threads` results are computed ahead of the one being consumed,
+    so that the memory of the results in flight is bounded.
+
+    :param func: Function of an item.
+    :param items: Items.
+    :param n_threads: Number of threads (computed in the calling thread if 1).
+    """
+    if n_threads <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= n_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def prefetch(func: Callable, items: Iterable, depth: int = 1, name: str = "prefetch") -> Iterator[Any]:
+    """
+    Results of `func` on the items in order, computed ahead on a background thread.
+
+    While the consumer uses a result, the thread computes the next ones, up
+    to `depth` results ahead, so that at most `depth + 1` results are held
+    at once. An exception of `func` is raised in the consumer. If the
+    consumer stops, the thread stops after the result it is computing.
+
+    :param func: Function of an item.
+    :param items: Items (iterated in the background thread).
+    :param depth: Number of results computed ahead (computed in the calling thread if 0).
+    :param name: Name of the thread (shown in the logs).
+    """
+    if depth <= 0:
+        for item in items:
+            yield func(item)
+        return
+
+    results = queue.Queue()
+    slots = threading.Semaphore(depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                results.put((True, func(item)))
+        except BaseException as e:
+            results.put((False, e))
+            return
+        results.put((None, None))
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, value = results.get()
+            if ok is None:
+                return
+            if not ok:
+                raise value
+            # the slot of a result is freed when the consumer takes it
+            slots.release()
+            yield value
+            value = None
+    finally:
+        stop.set()
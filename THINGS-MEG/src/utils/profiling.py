@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import pandas as pd
+
+
+# The trace file and the run id are passed to the joblib workers through the
+# environment, so that spans in spawned or forked workers are recorded too.
+TRACE_ENV = "THINGSMEG_TRACE"
+RUN_ENV = "THINGSMEG_TRACE_RUN"
+
+_local = threading.local()
+_lock = threading.Lock()
+_open_spans = {"pid": None, "n": 0}
+
+
+def enable(trace_file: str, run_id: Optional[str] = None) -> str:
+    """
+    Record the spans of this process and its workers to a trace file.
+
+    :param trace_file: JSONL trace file (appended to).
+    :param run_id: Identifier of the records of this run (default: current time).
+
+    :return: Identifier of the run.
+    """
+    run_id = run_id or time.strftime("%Y-%m-%dT%H:%M:%S")
+    os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+    os.environ[TRACE_ENV] = os.path.abspath(trace_file)
+    os.environ[RUN_ENV] = run_id
+    return run_id
+
+
+def disable() -> None:
+    """
+    Stop recording spans.
+    """
+    os.environ.pop(TRACE_ENV, None)
+    os.environ.pop(RUN_ENV, None)
+
+
+def _stack() -> List[Dict]:
+    # open spans of the current thread (reset in a forked worker)
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.stack = []
+    return _local.stack
+
+
+def _enter_process() -> bool:
+    # count the open spans of the process (all threads); True for the first one
+    with _lock:
+        if _open_spans["pid"] != os.getpid():
+            _open_spans["pid"], _open_spans["n"] = os.getpid(), 0
+        _open_spans["n"] += 1
+        return _open_spans["n"] == 1
+
+
+def _exit_process() -> None:
+    with _lock:
+        _open_spans["n"] -= 1
+
+
+def _read_proc(path: str, fields: List[str]) -> Dict[str, int]:
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in fields:
+                    values[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return values
+
+
+def _usage() -> Dict[str, Optional[int]]:
+    # CPU time, peak RSS (bytes) and bytes read/written by the process
+    status = _read_proc("/proc/self/status", ["VmHWM"])
+    io = _read_proc("/proc/self/io", ["rchar", "wchar"])
+    peak_rss = status["VmHWM"] * 1024 if "VmHWM" in status else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        "cpu": time.process_time(),
+        "peak_rss": peak_rss,
+        "read_bytes": io.get("rchar"),
+        "write_bytes": io.get("wchar"),
+    }
+
+
+def _reset_peak_rss() -> None:
+    # reset VmHWM to the current RSS (Linux only)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+@contextmanager
+def span(stage: str, **tags) -> Iterator[None]:
+    """
+    Time a stage and append its record to the trace (see `enable`).
+
+    A record has the wall and CPU time of the stage, the bytes read and
+    written by the process during the stage (`/proc/self/io`), and the peak
+    RSS of the process. The peak RSS is reset when a span starts while no
+    other span of the process (in any thread) is open, so that it is the
+    peak since then (not the peak of the stage alone in nested or concurrent
+    spans). The tags (e.g., participant, session, run) of the enclosing spans
+    of the same thread are added to the record; spans in a new thread do not
+    inherit the tags of the thread which started it.
+    Nothing is recorded when the trace is not enabled.
+
+    :param stage: Stage name.
+    :param tags: Tags of the record.
+    """
+    trace_file = os.environ.get(TRACE_ENV)
+    if not trace_file:
+        yield
+        return
+
+    stack = _stack()
+    tags = dict(stack[-1], **tags) if stack else tags
+    if _enter_process():
+        _reset_peak_rss()
+    stack.append(tags)
+    start, wall0, usage0 = time.time(), time.perf_counter(), _usage()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        wall, usage = time.perf_counter() - wall0, _usage()
+        stack.pop()
+        _exit_process()
+        record = {
+            "run_id": os.environ.get(RUN_ENV),
+            "stage": stage,
+            **tags,
+            "pid": os.getpid(),
+            "start": start,
+            "wall_s": wall,
+            "cpu_s": usage["cpu"] - usage0["cpu"],
+            "peak_rss": usage["peak_rss"],
+            "read_bytes": None if usage["read_bytes"] is None else usage["read_bytes"] - usage0["read_bytes"],
+            "write_bytes": None if usage["write_bytes"] is None else usage["write_bytes"] - usage0["write_bytes"],
+            "status": status,
+        }
+        # one write per record, so that the records of concurrent workers are not interleaved
+        with open(trace_file, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+def read_trace(trace_file: str, run_id: Optional[str] = None) -> pd.DataFrame:
+    """
+    Read a trace.
+
+    :param trace_file: JSONL trace file.
+    :param run_id: Run to read (default: all runs).
+
+    :return: One row per span.
+    """
+    with open(trace_file) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    trace = pd.DataFrame.from_records(records)
+    if run_id is not None and len(trace):
+        trace = trace[trace["run_id"] == run_id]
+    return trace
+
+
+def summarize(trace: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summary of a trace by stage (in the order of the first span of each stage).
+
+    :param trace: Trace (see `read_trace`).
+
+    :return: Number of spans, total and maximum wall time (s), total CPU time (s), maximum peak RSS (GiB), and total GiB read and written of each stage.
+    """
+    if len(trace) == 0:
+        return pd.DataFrame()
+    gib = 1024 ** 3
+    trace = trace.sort_values("start", kind="stable")
+    grouped = trace.groupby("stage", sort=False)
+    return pd.DataFrame({
+        "n": grouped.size(),
+        "wall_s": grouped["wall_s"].sum(),
+        "max_wall_s": grouped["wall_s"].max(),
+        "cpu_s": grouped["cpu_s"].sum(),
+        "peak_rss_gib": grouped["peak_rss"].max() / gib,
+        "read_gib": grouped["read_bytes"].sum() / gib,
+        "write_gib": grouped["write_bytes"].sum() / gib,
+    }).round(3)
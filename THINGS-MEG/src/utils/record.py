@@ -1,8 +1,15 @@
+import atexit
 import logging
+import multiprocessing
 import sys
+import threading
+from contextlib import contextmanager
+from queue import Empty
 import hydra
+from logging.handlers import QueueHandler
 from omegaconf import DictConfig
 import logging.config
+from typing import Dict, Iterator, List, Optional
 
 class StreamToLogger:
     def __init__(self, logger, log_level=logging.INFO):
@@ -20,18 +27,182 @@ class StreamToLogger:
         pass
 
 
-def setup_logging():
-    logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s - %(levelname)s - %(message)s',
-                        filename='app.log',
-                        filemode='a')
+class LogListener:
+    """
+    Thread writing the log records of the parent process and its workers.
 
-    stdout_logger = logging.getLogger('STDOUT')
-    sys.stdout = StreamToLogger(stdout_logger, logging.INFO)
+    Records are taken from a multiprocessing queue and passed to the
+    handlers in batches: all records waiting in the queue (up to
+    `batch_size`) are written to the stream of each stream handler before
+    a single flush, so that the processes which log never wait for the file.
+    """
 
-    stderr_logger = logging.getLogger('STDERR')
-    sys.stderr = StreamToLogger(stderr_logger, logging.ERROR)
+    def __init__(self, queue, handlers: List[logging.Handler], batch_size: int = 1024):
+        self.queue = queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self._thread = None
 
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._monitor, name="LogListener", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Write the remaining records and stop the thread.
+        """
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _monitor(self) -> None:
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if None in batch:
+                done = True
+                batch = batch[:batch.index(None)]
+            self.handle(batch)
+
+    def handle(self, records: List[logging.LogRecord]) -> None:
+        for handler in self.handlers:
+            if not isinstance(handler, logging.StreamHandler) or handler.stream is None:
+                for record in records:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                continue
+            with handler.lock:
+                try:
+                    for record in records:
+                        if record.levelno >= handler.level and handler.filter(record):
+                            handler.stream.write(handler.format(record) + handler.terminator)
+                    handler.flush()
+                except Exception:
+                    handler.handleError(records[-1])
+
+
+_context = threading.local()
+
+
+class ContextFilter(logging.Filter):
+    """
+    Prefix the messages with the log context of the thread (see `log_context`), e.g., "[participant 1 session 3] ".
+    """
+
+    def filter(self, record):
+        tags = getattr(_context, 'tags', None)
+        if tags:
+            prefix = " ".join(f"{k} {v}" for k, v in tags.items())
+            record.msg = f"[{prefix}] {record.msg}"
+        return True
+
+
+@contextmanager
+def log_context(**tags) -> Iterator[None]:
+    """
+    Attribute the log records of the current thread to the tags (e.g., participant, session).
+
+    The messages logged in the context (including the MNE logs and the
+    printed output) are prefixed with the tags of the enclosing contexts of
+    the thread, a tag of an inner context replacing the same tag of an outer
+    one. New threads start without tags, and forked workers keep the tags of
+    the thread which forked them.
+    """
+    previous = getattr(_context, 'tags', None)
+    _context.tags = dict(previous or {}, **tags)
+    try:
+        yield
+    finally:
+        _context.tags = previous
+
+
+_queue = None
+_level = logging.WARNING
+_mne_level = None
+
+
+def configure_process(queue, level: int = logging.WARNING, mne_level: Optional[str] = None) -> None:
+    """
+    Send the log records and the output of the current process to a queue.
+
+    This is the initializer of the worker processes (see `worker_initializer`).
+    The records of MNE are logged by the `mne` logger with their level, and
+    records below `mne_level` are dropped in the process which logs them.
+
+    :param queue: Queue read by the `LogListener` of the parent process.
+    :param level: Level of the root logger.
+    :param mne_level: Level of the MNE records (default: unchanged).
+    """
+    handler = QueueHandler(queue)
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+    mne_logger = logging.getLogger('mne')
+    mne_logger.handlers = []
+    mne_logger.propagate = True
+    if mne_level is not None:
+        mne_logger.setLevel(mne_level)
+
+    sys.stdout = StreamToLogger(logging.getLogger('STDOUT'), logging.INFO)
+    sys.stderr = StreamToLogger(logging.getLogger('STDERR'), logging.ERROR)
+
+
+def worker_initializer() -> Dict:
+    """
+    Keyword arguments of `joblib.Parallel` (multiprocessing backend) that forward the logs of the workers to the parent.
+
+    :return: `initializer` and `initargs`, or nothing if `setup_logging` was not called.
+    """
+    if _queue is None:
+        return {}
+    return {"initializer": configure_process, "initargs": (_queue, _level, _mne_level)}
+
+
+def setup_logging(log_file: str = 'app.log', mne_level: Optional[str] = None) -> LogListener:
+    """
+    Log through a queue and a listener thread.
+
+    The handlers of the root logger (the console and file handlers of hydra,
+    or a handler of `log_file` if there is none) are moved to a `LogListener`,
+    and the root logger, stdout and stderr of this process (and of the workers
+    started with `worker_initializer`) send their records to its queue. The
+    listener is stopped, and the handlers are restored, at exit.
+
+    :param log_file: Log file used when the root logger has no handler.
+    :param mne_level: Level of the MNE records, e.g., "WARNING" (default: unchanged).
+
+    :return: Log listener.
+    """
+    global _queue, _level, _mne_level
+
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    if not handlers:
+        handler = logging.FileHandler(log_file, mode='a')
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handlers = [handler]
+
+    _queue = multiprocessing.Queue()
+    _level, _mne_level = root.level, mne_level
+    listener = LogListener(_queue, handlers)
+    listener.start()
+    configure_process(_queue, _level, mne_level)
+
+    def stop():
+        listener.stop()
+        root.handlers = handlers
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+
+    atexit.register(stop)
+    return listener
 
 
 
@@ -0,0 +1,132 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from typing import Any, Callable, Optional
+
+
+class StageCache:
+    """
+    On-disk cache of intermediate preprocessing results with an LRU size cap.
+
+    Each entry is a directory `<cache_dir>/<stage>-<hash of params>` holding
+    the files written by the saver. The params include the identity of the
+    source files (see `source_identity`), so that an entry is not reused for
+    another BIDS directory or a changed source file. Entries are written to a temporary
+    directory and renamed, so that concurrent workers never read a partial
+    entry. The mtime of an entry is updated on every hit, and the least
+    recently used entries are removed when the cache exceeds `max_size_gb`.
+    """
+
+    version = 2
+
+    def __init__(self, cache_dir: str, max_size_gb: float = 100, logger: Optional[logging.Logger] = None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_gb * 1024 ** 3
+        self.logger = logger or logging.getLogger(__name__)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # loggers are not pickled to the joblib workers
+        state = self.__dict__.copy()
+        state["logger"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger(__name__)
+
+    def key(self, stage: str, **params) -> str:
+        """
+        Key of the result of `stage` computed with `params`.
+        """
+        params = dict(params, version=self.version)
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        return f"{stage}-{digest}"
+
+    def load(self, key: str, loader: Callable[[str], Any]) -> Optional[Any]:
+        """
+        Load an entry.
+
+        :param key: Key (see `key`).
+        :param loader: Function loading the result from the entry directory.
+
+        :return: The result, or None if the entry is not in the cache.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            return None
+        try:
+            os.utime(entry_dir)
+            result = loader(entry_dir)
+        except FileNotFoundError:
+            # evicted by another worker
+            return None
+        self.logger.info(f"Cache hit: {key}")
+        return result
+
+    def save(self, key: str, saver: Callable[[str], None]) -> None:
+        """
+        Save an entry and evict the least recently used entries if the cache is full.
+
+        :param key: Key (see `key`).
+        :param saver: Function saving the result into the (empty) entry directory.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = os.path.join(self.cache_dir, f".tmp-{key}-{os.getpid()}")
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            saver(tmp_dir)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # already saved by another worker
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(entry_dir):
+                raise
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache fits in `max_size_gb`.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith(".tmp-") or not os.path.isdir(entry_dir):
+                continue
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(root, f))
+                    for root, _, files in os.walk(entry_dir) for f in files
+                )
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_size:
+                break
+            self.logger.info(f"Cache evict: {os.path.basename(entry_dir)}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+def source_identity(path: str) -> list:
+    """
+    Identity of a source file, or of all files in a directory (e.g., CTF .ds), for cache keys.
+
+    :param path: File or directory.
+
+    :return: Absolute path, size and mtime (ns) of each file.
+    """
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+    identity = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            identity.append(source_identity(os.path.join(root, name)))
+    return [os.path.abspath(path), identity]
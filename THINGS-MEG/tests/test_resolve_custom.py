@@ -0,0 +1,29 @@
+import os
+
+from hydra import compose, initialize_config_dir
+from omegaconf import open_dict
+
+from src.preproc_thingsmeg import resolve_custom
+
+config_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs")
+
+
+def make_config(overrides):
+    with initialize_config_dir(config_dir=config_dir, version_base=None):
+        return compose(config_name="make", overrides=overrides)
+
+
+def test_command_line_override():
+    # as in the README: the key of the participant is the string '2'
+    cfg = make_config(["make_type=custom", "+custom_overrides.2.l_freq=0.5"])
+    assert resolve_custom(cfg, 2).l_freq == 0.5
+    assert resolve_custom(cfg, 1).l_freq == cfg.custom.l_freq
+
+
+def test_config_override():
+    # as in make.yaml: the key of the participant is the int 2
+    cfg = make_config(["make_type=custom"])
+    with open_dict(cfg):
+        cfg.custom_overrides = {2: {"l_freq": 0.5}}
+    assert resolve_custom(cfg, 2).l_freq == 0.5
+    assert resolve_custom(cfg, 3).l_freq == cfg.custom.l_freq
@@ -0,0 +1,754 @@
+"""Utilities to write BData files without building the whole BData in memory.
+
+The files written here have the same layout as `bdpy.BData.save` (HDF5) and
+can be loaded with `bdpy.BData`.
+"""
+
+
+from typing import Dict, List, Optional, Tuple, Union
+
+import datetime
+import json
+import os
+import re
+import time
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+
+
+PathType = Union[str, Path]
+IndexType = Union[slice, np.ndarray, None]
+
+
+class BDataWriter:
+    """Write BData to an HDF5 file block by block.
+
+    The dataset is created on the disk with the shape given by `n_samples`
+    and `columns` (list of (name, number of columns)) and filled with
+    `write`. Metadata and vmaps are kept in memory and written on `close`.
+
+    The dataset is stored in `dtype` with `chunks` (True for the h5py
+    default, a chunk shape, or 'rows'/'columns', see `chunk_shape`) and an
+    optional HDF5 compression filter. Since labels are stored in the same
+    dataset, `write` raises ValueError if the values of a single-column data
+    (e.g., stimulus numerals) are not exactly representable in `dtype`.
+
+    The file is written to `<file_name>.tmp` and renamed to `file_name` on
+    `close`, so that a partially written file is never found at `file_name`.
+    If the `with` block raises, the temporary file is removed (`abort`).
+
+    Example:
+
+        with BDataWriter('out.h5', 100, [('VoxelData', 1000), ('label', 1)]) as bdata:
+            bdata.write('VoxelData', x[:, :500], columns=slice(0, 500))
+            bdata.write('VoxelData', x[:, 500:], columns=slice(500, 1000))
+            bdata.write('label', y)
+            bdata.add_vmap('label', {0: 'a', 1: 'b'})
+    """
+
+    def __init__(
+            self,
+            file_name: PathType,
+            n_samples: int,
+            columns: List[Tuple[str, int]],
+            dtype: type = np.float64,
+            chunks: Union[bool, str, Tuple[int, int], None] = True,
+            compression: Optional[str] = None,
+            compression_opts=None,
+            shuffle: bool = False,
+    ) -> None:
+        self.file_name = str(file_name)
+        self.n_samples = n_samples
+
+        self.__columns = {}
+        n_columns = 0
+        for name, n in columns:
+            self.__columns[name] = slice(n_columns, n_columns + n)
+            n_columns += n
+        self.n_columns = n_columns
+
+        self.__metadata = []
+        for name, sl in self.__columns.items():
+            value = np.full(n_columns, np.nan)
+            value[sl] = 1
+            self.__metadata.append((name, '1 = %s' % name, value))
+
+        self.__vmap = {}
+        self.__roi_index = {}
+        self.__labels = {name: set() for name, sl in self.__columns.items() if sl.stop - sl.start == 1}
+
+        self.dtype = np.dtype(dtype)
+        if isinstance(chunks, str):
+            chunks = chunk_shape(chunks, n_samples, n_columns, self.dtype)
+        if n_samples == 0 or n_columns == 0:
+            chunks = None if compression is None and not shuffle else True
+
+        self.__tmp_file_name = temporary_file_name(self.file_name)
+        self.__h5file = h5py.File(self.__tmp_file_name, 'w')
+        self.__dataset = self.__h5file.create_dataset(
+            '/dataset', shape=(n_samples, n_columns), dtype=self.dtype,
+            chunks=chunks, compression=compression, compression_opts=compression_opts,
+            shuffle=shuffle
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def columns(self, name: str) -> slice:
+        """Return the column slice of `name` in the dataset."""
+        return self.__columns[name]
+
+    def write(self, name: str, data: np.ndarray, rows: IndexType = None, columns: IndexType = None) -> None:
+        """Write `data` to `rows` and `columns` (relative to `name`) of the dataset.
+
+        `rows` and `columns` are slices or sorted index arrays; None means all.
+        """
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+
+        if name in self.__labels:
+            values = np.unique(np.asarray(data, dtype=np.float64))
+            stored = values.astype(self.dtype).astype(np.float64)
+            if not np.array_equal(stored, values, equal_nan=True):
+                raise ValueError('%s has values not representable in %s (e.g., %s)' % (name, self.dtype, values[stored != values][:5]))
+
+        col_sl = self.__columns[name]
+        if columns is None:
+            cols = col_sl
+        elif isinstance(columns, slice):
+            start, stop, step = columns.indices(col_sl.stop - col_sl.start)
+            cols = slice(col_sl.start + start, col_sl.start + stop, step)
+        else:
+            cols = np.asarray(columns) + col_sl.start
+        if rows is None:
+            rows = slice(0, self.n_samples)
+
+        if isinstance(rows, slice) or isinstance(cols, slice):
+            self.__dataset[rows, cols] = data
+        else:
+            # h5py allows only one index array per selection
+            for i, r in enumerate(rows):
+                self.__dataset[r, cols] = data[i]
+
+        if name in self.__labels:
+            self.__labels[name].update(values.tolist())
+
+    def add_metadata(self, key: str, value: np.ndarray, description: str = '', where: Optional[str] = None) -> None:
+        """Add metadata (same as `BData.add_metadata`).
+
+        If `key` already exists, its values in the columns of `where` are
+        updated (e.g., to add the same metadata to several column groups).
+        """
+        if where is not None:
+            add_value = np.full(self.n_columns, np.nan)
+            add_value[self.__columns[where]] = value
+        else:
+            add_value = np.asarray(value, dtype=float)
+        for i, (k, d, v) in enumerate(self.__metadata):
+            if k == key:
+                if where is not None:
+                    add_value = np.where(np.isnan(add_value), v, add_value)
+                self.__metadata[i] = (key, description or d, add_value)
+                return
+        self.__metadata.append((key, description, add_value))
+
+    def add_vmap(self, key: str, vmap: Dict[float, str], prune: bool = True) -> None:
+        """Add vmap (same as `BData.add_vmap`).
+
+        Only the labels of the values written in the column are kept as in
+        `BData.add_vmap`, unless `prune` is False (as in files split from a
+        BData, which keep the vmap of the source).
+        """
+        if key not in self.__columns:
+            raise ValueError('%s not found in metadata.' % key)
+        self.__vmap[key] = vmap
+        if not prune:
+            self.__labels.pop(key, None)
+
+    def add_roi_index(self, key: str, index: np.ndarray, where: Optional[str] = None) -> None:
+        """Add the column indices of a ROI (relative to `where`), read by `load_roi`.
+
+        The indices are saved as a sorted array in `/roi_index/<key>`.
+        """
+        index = np.sort(np.asarray(index, dtype=np.int64))
+        if where is not None:
+            index = index + self.__columns[where].start
+        self.__roi_index[key] = index
+
+    def close(self) -> None:
+        """Write metadata, header, vmaps, and ROI indices, close the file, and rename it to `file_name`."""
+        if not self.__h5file:
+            return
+
+        h5file = self.__h5file
+
+        _write_metadata(
+            h5file,
+            [k for k, _, _ in self.__metadata],
+            [d for _, d, _ in self.__metadata],
+            np.vstack([v for _, _, v in self.__metadata])
+        )
+        _write_header(h5file)
+
+        # vmap (only the labels of the values in the dataset)
+        vmap = {}
+        for mk, vm in self.__vmap.items():
+            values = self.__labels.get(mk)
+            vmap[mk] = {k: v for k, v in vm.items() if values is None or float(k) in values}
+        _write_vmap(h5file, vmap)
+
+        if self.__roi_index:
+            h5file.create_group('/roi_index')
+            for key, index in self.__roi_index.items():
+                h5file.create_dataset('/roi_index/' + key, data=index)
+
+        h5file.close()
+        self.__h5file = None
+        os.replace(self.__tmp_file_name, self.file_name)
+
+    def abort(self) -> None:
+        """Close and remove the temporary file without writing `file_name`."""
+        if not self.__h5file:
+            return
+        self.__h5file.close()
+        self.__h5file = None
+        os.remove(self.__tmp_file_name)
+
+
+def temporary_file_name(file_name: PathType) -> str:
+    """Temporary file to which `file_name` is written before it is renamed (see `BDataWriter`)."""
+    return str(file_name) + '.tmp'
+
+
+class ShardedBDataWriter:
+    """Write BData to row shards of at most `shard_size` samples, with a shard index.
+
+    The shards are BData files (see `BDataWriter`) named
+    `<stem>.shard-00000.h5`, ... next to `file_name`, each with the same
+    columns, metadata, vmaps (not pruned), and ROI indices, so that any shard
+    can be loaded alone (e.g., by the workers of a training job). `write` takes
+    the rows of the samples in the source order; the samples are stored in
+    the order `order` (source row of each stored sample, e.g., stimuli
+    shuffled with `shuffle_groups`), or in the source order if None.
+
+    On `close`, the shard index (`shard_index_file_name`, JSON) is written
+    with the stored rows (global row range) and the values of the
+    single-column data (e.g., stimulus numerals) of each shard, and the
+    source row of each stored sample if `order` is given (see
+    `read_shard_index` and `locate_rows`). The index is written last, so
+    that it is found only when all the shards are complete. Shards of a
+    previous build of `file_name` beyond the new ones are removed.
+
+    Example:
+
+        order = shuffle_groups(stimulus, seed=0)
+        with ShardedBDataWriter('out.h5', 1000, [('VoxelData', 500), ('stimulus_name', 1)], 100, order=order) as bdata:
+            bdata.write('VoxelData', x)
+            bdata.write('stimulus_name', stimulus)
+    """
+
+    def __init__(
+            self,
+            file_name: PathType,
+            n_samples: int,
+            columns: List[Tuple[str, int]],
+            shard_size: int,
+            order: Optional[np.ndarray] = None,
+            **storage
+    ) -> None:
+        if shard_size < 1:
+            raise ValueError('shard_size must be positive: %s' % shard_size)
+        self.file_name = str(file_name)
+        self.n_samples = n_samples
+        self.shard_size = shard_size
+        self.__columns = list(columns)
+        self.__single = [name for name, n in columns if n == 1]
+
+        self.__order = None
+        self.__position = None
+        if order is not None:
+            self.__order = np.asarray(order, dtype=np.int64)
+            if not np.array_equal(np.sort(self.__order), np.arange(n_samples)):
+                raise ValueError('order is not a permutation of the %d samples' % n_samples)
+            self.__position = np.argsort(self.__order)
+
+        n_shards = max(1, -(-n_samples // shard_size))
+        self.__bounds = [(i * shard_size, min(n_samples, (i + 1) * shard_size)) for i in range(n_shards)]
+        self.__labels = [{name: set() for name in self.__single} for _ in self.__bounds]
+        self.__shards = []
+        try:
+            for i, (start, stop) in enumerate(self.__bounds):
+                self.__shards.append(BDataWriter(shard_file_name(self.file_name, i), stop - start, columns, **storage))
+        except BaseException:
+            self.abort()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def columns(self, name: str) -> slice:
+        """Return the column slice of `name` in the dataset."""
+        return self.__shards[0].columns(name)
+
+    def write(self, name: str, data: np.ndarray, rows: IndexType = None, columns: IndexType = None) -> None:
+        """Write `data` to the samples at `rows` (in the source order) and `columns` (relative to `name`).
+
+        `rows` is a slice or an index array; None means all.
+        """
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        rows = np.arange(self.n_samples)[rows if rows is not None else slice(None)]
+        position = rows if self.__position is None else self.__position[rows]
+
+        shard = position // self.shard_size
+        for i in np.unique(shard):
+            index = np.flatnonzero(shard == i)
+            local = position[index] - self.__bounds[i][0]
+            sort = np.argsort(local, kind='stable')
+            index, local = index[sort], local[sort]
+            if len(local) == local[-1] - local[0] + 1:
+                local = slice(int(local[0]), int(local[-1]) + 1)
+            self.__shards[i].write(name, data[index], rows=local, columns=columns)
+            if name in self.__labels[i]:
+                self.__labels[i][name].update(np.unique(np.asarray(data[index], dtype=np.float64)).tolist())
+
+    def add_metadata(self, key: str, value: np.ndarray, description: str = '', where: Optional[str] = None) -> None:
+        """Add metadata to all the shards (see `BDataWriter.add_metadata`)."""
+        for shard in self.__shards:
+            shard.add_metadata(key, value, description, where=where)
+
+    def add_vmap(self, key: str, vmap: Dict[float, str], prune: bool = False) -> None:
+        """Add the same vmap to all the shards (see `BDataWriter.add_vmap`; not pruned by default)."""
+        for shard in self.__shards:
+            shard.add_vmap(key, vmap, prune=prune)
+
+    def add_roi_index(self, key: str, index: np.ndarray, where: Optional[str] = None) -> None:
+        """Add a ROI index to all the shards (see `BDataWriter.add_roi_index`)."""
+        for shard in self.__shards:
+            shard.add_roi_index(key, index, where=where)
+
+    def close(self) -> None:
+        """Close the shards, and write the shard index."""
+        if not self.__shards:
+            return
+        for shard in self.__shards:
+            shard.close()
+
+        index = {
+            'n_samples': self.n_samples,
+            'columns': [[name, n] for name, n in self.__columns],
+            'shard_size': self.shard_size,
+            'shards': [
+                {
+                    'file': os.path.basename(shard_file_name(self.file_name, i)),
+                    'rows': [start, stop],
+                    'labels': {name: sorted(values) for name, values in self.__labels[i].items()},
+                }
+                for i, (start, stop) in enumerate(self.__bounds)
+            ],
+        }
+        if self.__order is not None:
+            index['source_rows'] = self.__order.tolist()
+        index_file = shard_index_file_name(self.file_name)
+        with open(temporary_file_name(index_file), 'w') as f:
+            json.dump(index, f)
+        os.replace(temporary_file_name(index_file), index_file)
+
+        # shards of a previous build with more shards
+        i = len(self.__shards)
+        while os.path.exists(shard_file_name(self.file_name, i)):
+            os.remove(shard_file_name(self.file_name, i))
+            i += 1
+        self.__shards = []
+
+    def abort(self) -> None:
+        """Remove the temporary files of the shards without writing the shards and the index."""
+        for shard in self.__shards:
+            shard.abort()
+        self.__shards = []
+
+
+def shard_file_name(file_name: PathType, shard: int) -> str:
+    """File of a shard of `file_name` (e.g., sub-01_train.shard-00000.h5 for sub-01_train.h5)."""
+    stem, ext = os.path.splitext(str(file_name))
+    return '%s.shard-%05d%s' % (stem, shard, ext)
+
+
+def shard_index_file_name(file_name: PathType) -> str:
+    """Shard index of `file_name` (e.g., sub-01_train.shards.json for sub-01_train.h5)."""
+    return os.path.splitext(str(file_name))[0] + '.shards.json'
+
+
+def shuffle_groups(labels: np.ndarray, seed: Optional[int] = None) -> np.ndarray:
+    """Row order with the groups of rows with the same label in random order.
+
+    The rows of a label stay together in their original order (e.g., the
+    repetitions of a stimulus), so that a stimulus is split over at most two
+    shards while the shards have random stimuli.
+    """
+    order, starts, _ = group_rows(labels)
+    ends = np.r_[starts[1:], len(order)].astype(int)
+    groups = np.random.default_rng(seed).permutation(len(starts))
+    if len(groups) == 0:
+        return order
+    return np.concatenate([order[starts[g]:ends[g]] for g in groups])
+
+
+def read_shard_index(file_name: PathType) -> Dict:
+    """Read the shard index of `file_name` (the BData file name or the index file), with the paths of the shards."""
+    index_file = str(file_name)
+    if not index_file.endswith('.shards.json'):
+        index_file = shard_index_file_name(index_file)
+    with open(index_file) as f:
+        index = json.load(f)
+    for shard in index['shards']:
+        shard['path'] = os.path.join(os.path.dirname(index_file), shard['file'])
+    return index
+
+
+def locate_rows(index: Dict, rows: np.ndarray) -> List[Tuple[str, np.ndarray, np.ndarray]]:
+    """Shards of the stored rows `rows` (global indices in the order of the shards).
+
+    Returns (shard path, positions in `rows`, rows in the shard) for each
+    shard with rows, e.g., to load a batch of samples with `load_roi`.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.array([shard['rows'][0] for shard in index['shards']])
+    shard = np.searchsorted(starts, rows, side='right') - 1
+    located = []
+    for i in np.unique(shard):
+        positions = np.flatnonzero(shard == i)
+        located.append((index['shards'][i]['path'], positions, rows[positions] - starts[i]))
+    return located
+
+
+def roi_index_from_metadata(metadata: Dict[str, np.ndarray], exclude: Tuple[str, ...] = ()) -> Dict[str, np.ndarray]:
+    """Column indices of the ROIs defined by binary (0/1) metadata, such as ROI mask columns of voxel metadata.
+
+    Constant columns (e.g., a flag which is 1 for all the voxels) are not ROIs.
+    """
+    roi_index = {}
+    for key, value in metadata.items():
+        if key in exclude:
+            continue
+        value = np.asarray(value)
+        if value.size == 0 or not np.all((value == 0) | (value == 1)) or np.all(value == value.flat[0]):
+            continue
+        roi_index[key] = np.flatnonzero(value == 1)
+    return roi_index
+
+
+def roi_names(file_name: PathType) -> List[str]:
+    """Names of the ROIs indexed in a BData file (see `BDataWriter.add_roi_index`)."""
+    with h5py.File(str(file_name), 'r') as h5file:
+        return list(h5file['roi_index'].keys()) if 'roi_index' in h5file else []
+
+
+def load_roi(file_name: PathType, roi: str, rows: Union[slice, np.ndarray, None] = None) -> np.ndarray:
+    """Load the columns of a ROI (samples x voxels) from a BData file.
+
+    Only the columns in `/roi_index/<roi>` are read, as one hyperslab per
+    contiguous run of columns, so that the rest of the dataset is not read
+    (with chunks='columns', only the chunks of the ROI are touched). `rows`
+    (a slice or sorted indices) selects the samples.
+    """
+    with h5py.File(str(file_name), 'r') as h5file:
+        if 'roi_index' not in h5file or roi not in h5file['roi_index']:
+            raise KeyError('ROI %s not found in %s' % (roi, file_name))
+        index = h5file['roi_index/' + roi][:]
+        dataset = h5file['dataset']
+        if rows is None:
+            rows = slice(None)
+        breaks = np.flatnonzero(np.diff(index) != 1) + 1
+        starts = np.r_[0, breaks]
+        stops = np.r_[breaks, len(index)]
+        blocks = [dataset[rows, index[a]:index[b - 1] + 1] for a, b in zip(starts, stops)]
+        if not blocks:
+            return np.zeros((len(dataset[rows, 0]), 0), dtype=dataset.dtype)
+        return np.hstack(blocks)
+
+
+def chunk_shape(layout: str, n_samples: int, n_columns: int, dtype: type = np.float64, chunk_bytes: int = 2 ** 20) -> Union[bool, Tuple[int, int]]:
+    """HDF5 chunk shape of a dataset (samples x columns) for an access pattern.
+
+    'rows': chunks of whole rows (or parts of a row if a row is larger than
+    `chunk_bytes`), for writing and reading samples in order (e.g., trials
+    streamed from MEG epochs). 'columns': chunks of whole columns, for
+    reading a subset of columns (e.g., the voxels of a ROI). 'auto': the
+    h5py default.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    n_items = max(1, chunk_bytes // itemsize)
+    if n_samples == 0 or n_columns == 0 or layout == 'auto':
+        return True
+    if layout == 'rows':
+        if n_columns > n_items:
+            return (1, n_items)
+        return (min(n_samples, n_items // n_columns), n_columns)
+    if layout == 'columns':
+        if n_samples > n_items:
+            return (n_items, 1)
+        return (n_samples, min(n_columns, n_items // n_samples))
+    raise ValueError('Unknown chunk layout: %s' % layout)
+
+
+def available_memory() -> int:
+    """Return the available memory (bytes)."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def split_bdata(src_file: PathType, splits: Dict[PathType, str], block_size: Optional[int] = None) -> Dict[str, float]:
+    """Split a BData file into files of the samples selected by selectors.
+
+    `splits` maps output files to selector expressions evaluated on the
+    single-column data in the source file (e.g., `'trial_type == 1'` or
+    `'session <= 3 & trial_type == 1'`). The source is read once in blocks of
+    `block_size` rows (default: about 256 MB per block) and each block is
+    written to all splits, so that the whole dataset is never loaded. Metadata
+    and vmaps are copied from the source. Each output file is written to a
+    temporary file and renamed when it is complete (see `BDataWriter`).
+
+    Returns the time (s) spent on each split.
+
+    Example (per-session folds):
+
+        split_bdata('sub-01.h5', {f'sub-01_ses-{s:02d}.h5': f'session == {s}' for s in range(1, 13)})
+    """
+    splits = {str(k): v for k, v in splits.items()}
+    elapsed = {k: 0.0 for k in splits}
+
+    with h5py.File(str(src_file), 'r') as src:
+        src_dataset = src['dataset']
+        n_samples, n_columns = src_dataset.shape
+
+        md_keys = [_to_unicode(x) for x in src['metadata/key'][:].tolist()]
+        md_descs = [_to_unicode(x) for x in src['metadata/description'][:].tolist()]
+        md_values = np.asarray(src['metadata/value'], dtype=float)
+
+        if block_size is None:
+            block_size = max(1, 2 ** 28 // max(1, n_columns * src_dataset.dtype.itemsize))
+
+        # Single-column data used in the selectors
+        label_columns = {}
+        for key, value in zip(md_keys, md_values):
+            if not any(re.search(r'\b%s\b' % re.escape(key), s) for s in splits.values()):
+                continue
+            if np.sum(value == 1) != 1 or np.sum(~np.isnan(value)) != 1:
+                continue
+            label_columns[key] = int(np.flatnonzero(value == 1)[0])
+        # Read in row blocks, so that each chunk is decompressed once for all labels
+        columns = sorted(set(label_columns.values()))
+        values = np.empty((n_samples, len(columns)), dtype=src_dataset.dtype)
+        if columns:
+            for start in range(0, n_samples, block_size):
+                stop = min(start + block_size, n_samples)
+                values[start:stop] = src_dataset[start:stop][:, columns]
+        labels = pd.DataFrame({key: values[:, columns.index(col)] for key, col in label_columns.items()})
+
+        masks = {}
+        for output_file, selector in splits.items():
+            t0 = time.perf_counter()
+            masks[output_file] = np.asarray(labels.eval(selector), dtype=bool)
+            elapsed[output_file] += time.perf_counter() - t0
+
+        dst_files = {}
+        cursors = {}
+        try:
+            for output_file, mask in masks.items():
+                t0 = time.perf_counter()
+                n = int(np.sum(mask))
+                dst = h5py.File(temporary_file_name(output_file), 'w')
+                chunks = None
+                if n > 0:
+                    chunks = tuple(min(c, s) for c, s in zip(src_dataset.chunks, (n, n_columns))) if src_dataset.chunks else True
+                dst.create_dataset(
+                    '/dataset', shape=(n, n_columns), dtype=src_dataset.dtype,
+                    chunks=chunks,
+                    compression=src_dataset.compression, compression_opts=src_dataset.compression_opts,
+                    shuffle=src_dataset.shuffle
+                )
+                dst_files[output_file] = dst
+                cursors[output_file] = 0
+                elapsed[output_file] += time.perf_counter() - t0
+
+            for start in range(0, n_samples, block_size):
+                stop = min(start + block_size, n_samples)
+                block = src_dataset[start:stop]
+                for output_file, mask in masks.items():
+                    t0 = time.perf_counter()
+                    block_mask = mask[start:stop]
+                    n = int(np.sum(block_mask))
+                    if n > 0:
+                        cursor = cursors[output_file]
+                        dst_files[output_file]['dataset'][cursor:cursor + n] = block[block_mask]
+                        cursors[output_file] += n
+                    elapsed[output_file] += time.perf_counter() - t0
+                del block
+
+            for output_file, dst in dst_files.items():
+                t0 = time.perf_counter()
+                _write_metadata(dst, md_keys, md_descs, md_values)
+                _write_header(dst)
+                if 'vmap' in src:
+                    src.copy(src['vmap'], dst, name='vmap')
+                else:
+                    dst.create_group('/vmap')
+                if 'roi_index' in src:
+                    src.copy(src['roi_index'], dst, name='roi_index')
+                dst.close()
+                os.replace(temporary_file_name(output_file), output_file)
+                elapsed[output_file] += time.perf_counter() - t0
+                print(f"Saved {output_file} ({cursors[output_file]} samples, {elapsed[output_file]:.2f} s)")
+        finally:
+            # remove the files not completed (e.g., on an error)
+            for output_file, dst in dst_files.items():
+                if dst:
+                    dst.close()
+                    os.remove(temporary_file_name(output_file))
+
+    return elapsed
+
+
+def load_vocabulary(file_name: PathType) -> Dict[str, int]:
+    """Load a label vocabulary (label -> numeral).
+
+    The file is a CSV or TSV file with `label` and `index` columns, e.g.:
+
+        label,index
+        aardvark_01b,1
+        aardvark_02s,2
+    """
+    vocabulary = pd.read_csv(str(file_name), sep=None, engine='python', dtype={'label': str})
+    return dict(zip(vocabulary['label'], vocabulary['index'].astype(int)))
+
+
+def encode_labels(
+        labels: np.ndarray,
+        vocabulary: Union[Dict[str, int], PathType, None] = None,
+        start: int = 0
+) -> Tuple[np.ndarray, Dict[int, str]]:
+    """Convert labels into numerals and a vmap (numeral -> label).
+
+    If `vocabulary` (label -> numeral, or a vocabulary file, see
+    `load_vocabulary`) is not given, labels are numbered in sorted order from
+    `start`. The vocabulary is looked up once per unique label.
+    """
+    label_set, label_index = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+    if vocabulary is None:
+        vocabulary = {s: i + start for i, s in enumerate(label_set.tolist())}
+    elif not isinstance(vocabulary, dict):
+        vocabulary = load_vocabulary(vocabulary)
+    missing = [s for s in label_set.tolist() if s not in vocabulary]
+    if missing:
+        raise ValueError('%d labels not found in the vocabulary (e.g., %s)' % (len(missing), ', '.join(missing[:5])))
+    numeral = np.array([vocabulary[s] for s in label_set.tolist()], dtype=int)[label_index.ravel()]
+    vmap = {v: k for k, v in vocabulary.items()}
+    return numeral, vmap
+
+
+def group_rows(labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Group rows by label.
+
+    Returns `order` (row indices sorted by label; the rows of a label keep
+    their original order), `starts` (start of each group in `order`), and
+    the label of each group. The rows `order[starts[i]:starts[i + 1]]` have
+    the label of the i-th group.
+    """
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    if len(labels) == 0:
+        return order, np.array([], dtype=int), sorted_labels
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+    return order, starts, sorted_labels[starts]
+
+
+def aggregate_rows(data: np.ndarray, starts: np.ndarray, method: str = 'mean') -> np.ndarray:
+    """Average (or take the median of) the groups of consecutive rows of `data`.
+
+    `starts` is the start row of each group (see `group_rows`; `data` should
+    be sorted by group, e.g., `data[order]`). The mean is computed with
+    `np.add.reduceat` in float64. The median of groups of different sizes is
+    computed on the groups padded with NaN.
+    """
+    counts = np.diff(np.r_[starts, len(data)]).astype(int)
+    if len(starts) == 0:
+        return np.zeros((0,) + data.shape[1:])
+    if method == 'mean':
+        return np.add.reduceat(data, starts, axis=0, dtype=np.float64) / counts.reshape((-1,) + (1,) * (data.ndim - 1))
+    if method == 'median':
+        if np.all(counts == counts[0]):
+            return np.median(data.reshape((len(starts), counts[0]) + data.shape[1:]), axis=1)
+        padded = np.full((len(starts), counts.max()) + data.shape[1:], np.nan)
+        rank = np.arange(len(data)) - np.repeat(starts, counts)
+        padded[np.repeat(np.arange(len(starts)), counts), rank] = data
+        return np.nanmedian(padded, axis=1)
+    raise ValueError('Unknown aggregation method: %s' % method)
+
+
+def aggregate_labels(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """Value of each group of consecutive rows of `values`, or NaN if the value is not the same in the group."""
+    if len(starts) == 0:
+        return np.zeros(0)
+    values = np.asarray(values, dtype=float)
+    vmin = np.minimum.reduceat(values, starts)
+    vmax = np.maximum.reduceat(values, starts)
+    return np.where(vmin == vmax, vmin, np.nan)
+
+
+def _write_metadata(h5file: h5py.File, keys: List[str], descriptions: List[str], values: np.ndarray) -> None:
+    h5file.create_group('/metadata')
+    h5file.create_dataset('/metadata/key', data=[_to_bytes(x) for x in keys])
+    h5file.create_dataset('/metadata/description', data=[_to_bytes(x) for x in descriptions])
+    h5file.create_dataset('/metadata/value', data=values)
+
+
+def _write_header(h5file: h5py.File) -> None:
+    t_now = time.time()
+    h5file.create_group('/header')
+    h5file.create_dataset('/header/ctime', data=_to_bytes(datetime.datetime.fromtimestamp(t_now).strftime('%Y-%m-%d %H:%M:%S')))
+    h5file.create_dataset('/header/ctime_epoch', data=t_now)
+
+
+def _write_vmap(h5file: h5py.File, vmap: Dict[str, Dict[float, str]]) -> None:
+    h5file.create_group('/vmap')
+    for mk, vm in vmap.items():
+        h5file.create_group('/vmap/' + mk)
+        for k, v in vm.items():
+            h5file.create_dataset('/vmap/' + mk + '/' + str(float(k)), data=_to_bytes(v))
+
+
+def _to_unicode(s):
+    """Convert s (bytes) to unicode str."""
+    if isinstance(s, bytes):
+        return s.decode('utf-8')
+    return s
+
+
+def _to_bytes(s):
+    """Convert s (unicode str) to bytes."""
+    if isinstance(s, str):
+        return s.encode('utf-8')
+    return s
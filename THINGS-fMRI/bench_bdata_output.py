@@ -0,0 +1,110 @@
+"""Benchmark of the storage options of BData files on synthetic data.
+
+Writes a synthetic BData file (samples x columns of data and a label column)
+with `BDataWriter` for each combination of storage dtype, HDF5 chunk layout
+and compression, and reports the file size, write time, full load time
+(`bdpy.BData`), and the load time of a ROI (a subset of columns read with
+h5py). The ROI is made of a few contiguous runs of columns, as the voxels
+of a ROI in the voxel order of the response tables.
+
+Usage:
+
+    % python bench_bdata_output.py --n-samples 2000 --n-columns 50000 --dtypes float64 float32 --chunks rows columns --compressions none gzip
+
+The synthetic data are smooth along the columns (as neighbouring voxels or
+time points), so that the compression ratios are not those of white noise.
+"""
+
+
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+import bdpy
+import h5py
+import numpy as np
+
+from bdata_utils import BDataWriter
+
+
+def make_synthetic_data(n_samples: int, n_columns: int, smoothness: int = 8) -> np.ndarray:
+    """Random data smoothed along the columns (float64)."""
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((n_samples, n_columns + smoothness - 1))
+    kernel = np.ones(smoothness) / smoothness
+    data = np.cumsum(data, axis=1)
+    data = (data[:, smoothness - 1:] - np.c_[np.zeros(n_samples), data[:, :-smoothness]]) * kernel[0]
+    return data
+
+
+def write_bdata(file_name, data, labels, write_order='columns', block_size=5000, **storage):
+    """Write data in blocks of columns (as the fMRI converter) or rows (as the MEG converter)."""
+    n_samples, n_columns = data.shape
+    with BDataWriter(file_name, n_samples, [('VoxelData', n_columns), ('stimulus_name', 1)], **storage) as bdata:
+        if write_order == 'columns':
+            for start in range(0, n_columns, block_size):
+                sl = slice(start, min(start + block_size, n_columns))
+                bdata.write('VoxelData', data[:, sl], columns=sl)
+        else:
+            for start in range(0, n_samples, block_size):
+                sl = slice(start, min(start + block_size, n_samples))
+                bdata.write('VoxelData', data[sl], rows=sl)
+        bdata.write('stimulus_name', labels)
+        bdata.add_vmap('stimulus_name', {float(i): 'stim_%04d' % i for i in np.unique(labels)})
+
+
+def run_setting(file_name, data, labels, roi, write_order, **storage):
+    t0 = time.perf_counter()
+    write_bdata(file_name, data, labels, write_order=write_order, **storage)
+    t_write = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    bdpy.BData(file_name)
+    t_load = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with h5py.File(file_name, 'r') as f:
+        np.hstack([f['dataset'][:, sl] for sl in roi])
+    t_roi = time.perf_counter() - t0
+
+    size = os.path.getsize(file_name)
+    os.remove(file_name)
+    return size, t_write, t_load, t_roi
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-samples', type=int, default=2000)
+    parser.add_argument('--n-columns', type=int, default=50000)
+    parser.add_argument('--roi-size', type=int, default=2000, help='Number of columns of the ROI.')
+    parser.add_argument('--roi-segments', type=int, default=10, help='Number of contiguous runs of columns in the ROI.')
+    parser.add_argument('--dtypes', nargs='*', default=['float64', 'float32'], choices=['float64', 'float32'])
+    parser.add_argument('--chunks', nargs='*', default=['rows', 'columns'], choices=['auto', 'rows', 'columns'])
+    parser.add_argument('--compressions', nargs='*', default=['none', 'gzip'], choices=['none', 'gzip', 'lzf'])
+    parser.add_argument('--compression-level', type=int, default=4, help='gzip level.')
+    parser.add_argument('--write-order', default='columns', choices=['columns', 'rows'], help='Write data in blocks of columns (fMRI) or rows (MEG).')
+    args = parser.parse_args()
+
+    data = make_synthetic_data(args.n_samples, args.n_columns)
+    labels = np.random.default_rng(1).integers(0, 1000, args.n_samples).astype(float)
+    segment_size = args.roi_size // args.roi_segments
+    roi_starts = np.sort(np.random.default_rng(2).choice(args.n_columns // segment_size, args.roi_segments, replace=False)) * segment_size
+    roi = [slice(start, start + segment_size) for start in roi_starts]
+    print(f"Data: {args.n_samples} x {args.n_columns} ({data.nbytes / 1024 ** 2:.0f} MiB in float64), ROI: {args.roi_size} columns, write order: {args.write_order}")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'bench.h5')
+        for dtype, chunks, compression in itertools.product(args.dtypes, args.chunks, args.compressions):
+            storage = dict(dtype=np.dtype(dtype), chunks=chunks)
+            if compression != 'none':
+                storage.update(compression=compression, shuffle=True)
+                if compression == 'gzip':
+                    storage['compression_opts'] = args.compression_level
+            results.append(((dtype, chunks, compression), run_setting(file_name, data, labels, roi, args.write_order, **storage)))
+
+    print(f"{'dtype':<8} {'chunks':<8} {'compression':<12} {'size (MiB)':>11} {'write (s)':>10} {'load (s)':>10} {'ROI load (s)':>13}")
+    for (dtype, chunks, compression), (size, t_write, t_load, t_roi) in results:
+        print(f"{dtype:<8} {chunks:<8} {compression:<12} {size / 1024 ** 2:>11.1f} {t_write:>10.2f} {t_load:>10.2f} {t_roi:>13.3f}")
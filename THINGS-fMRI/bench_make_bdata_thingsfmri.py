@@ -0,0 +1,207 @@
+"""Benchmark of make_bdata_thingsfmri on synthetic data.
+
+Compares the previous conversion (per-trial `np.append`/`np.vstack` and
+`bdpy.BData`) with `make_bdata_things` (vectorized assembly, in-memory and
+streaming with several block sizes) on synthetic THINGS-fMRI files, and
+reports wall time and peak RSS of each. Each method runs in its own process
+so that the peak RSS is not shared between the methods.
+
+Usage:
+
+    % python bench_make_bdata_thingsfmri.py --n-trials 10000 --n-voxels 200000
+
+The default size (10k trials x 200k voxels) needs about 50 GB of RAM for the
+previous conversion; use smaller sizes on a workstation.
+"""
+
+
+from typing import Union
+
+import argparse
+import csv
+import multiprocessing
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import bdpy
+import numpy as np
+import pandas as pd
+
+from make_bdata_thingsfmri import make_bdata_things, peak_rss
+
+
+PathType = Union[str, Path]
+
+
+def make_synthetic_data(output_dir: PathType, n_trials: int, n_voxels: int, n_sessions: int = 12, n_runs: int = 10, sub: str = 'sub-01'):
+    """Make synthetic ResponseData, StimulusMetadata, and VoxelMetadata files."""
+    rng = np.random.default_rng(0)
+
+    session = np.sort(rng.integers(1, n_sessions + 1, n_trials))
+    run = np.zeros(n_trials, dtype=int)
+    for s in np.unique(session):
+        index = np.flatnonzero(session == s)
+        run[index] = np.sort(rng.integers(1, n_runs + 1, len(index)))
+        run[index[-1]] = n_runs
+    trial_type = np.where(rng.random(n_trials) < 0.1, 'test', 'train')
+    stimulus = [f"stim_{i:05d}.jpg" for i in rng.integers(0, max(n_trials // 2, 1), n_trials)]
+    stims = pd.DataFrame({
+        'trial_id': rng.permutation(n_trials),
+        'session': session,
+        'run': run,
+        'trial_type': trial_type,
+        'stimulus': stimulus,
+    })
+
+    voxels = pd.DataFrame({
+        'voxel_id': np.arange(n_voxels),
+        'voxel_x': rng.integers(0, 80, n_voxels),
+        'voxel_y': rng.integers(0, 80, n_voxels),
+        'voxel_z': rng.integers(0, 80, n_voxels),
+        'nc_testset': rng.random(n_voxels),
+        'V1': (rng.random(n_voxels) < 0.05).astype(int),
+        'V2': (rng.random(n_voxels) < 0.05).astype(int),
+        'LOC': (rng.random(n_voxels) < 0.05).astype(int),
+    })
+
+    resp = pd.DataFrame(rng.standard_normal((n_voxels, n_trials), dtype=np.float32), dtype=np.float64)
+    resp.insert(0, 'voxel_id', np.arange(n_voxels))
+
+    data_f = Path(output_dir) / f"{sub}_ResponseData.h5"
+    stim_f = Path(output_dir) / f"{sub}_StimulusMetadata.csv"
+    meta_f = Path(output_dir) / f"{sub}_VoxelMetadata.csv"
+    resp.to_hdf(data_f, key='ResponseData', mode='w')
+    stims.to_csv(stim_f, index=False)
+    voxels.to_csv(meta_f, index=False)
+
+    return data_f, stim_f, meta_f
+
+
+def legacy_make_bdata_things(data_f: PathType, stim_f: PathType, meta_f: PathType, output_file: PathType):
+    """Previous conversion (per-trial `np.append` and `np.vstack`)."""
+    with open(stim_f, 'r') as f:
+        reader = csv.DictReader(f)
+        stims = [row for row in reader]
+
+    with open(meta_f, 'r') as f:
+        reader = csv.DictReader(f)
+        voxels = [row for row in reader]
+
+    n_voxels = len(voxels)
+
+    resp = pd.read_hdf(data_f)
+
+    voxel_data_lst = []
+    trial_id = np.array([])
+    trial_type = np.array([])
+    run = np.array([])
+    session = np.array([])
+    stimulus_name = np.array([])
+
+    for stim in stims:
+        _trial_id = int(stim['trial_id'])
+        voxel_data_lst.append(resp[_trial_id].values)
+        trial_id = np.append(trial_id, _trial_id)
+        trial_type = np.append(trial_type, stim['trial_type'])
+        run = np.append(run, int(stim['run']))
+        session = np.append(session, int(stim['session']))
+        stimulus_name = np.append(stimulus_name, os.path.splitext(stim['stimulus'])[0])
+
+    voxel_data = np.vstack(voxel_data_lst)
+
+    run_inc = np.hstack(
+        [
+            np.repeat(
+                run[(session == n).flatten()][-1],
+                np.sum(session == n)
+            )
+            for n in np.unique(session)
+        ]
+    )
+    run = run + run_inc[:] * (session - 1)
+
+    metadatas = {k: np.zeros(n_voxels) for k in voxels[0]}
+    for i, voxel in enumerate(voxels):
+        for k, v in voxel.items():
+            metadatas[k][i] = float(v)
+
+    stimulus_set = np.unique(stimulus_name)
+    stimulus_name_vmap = {i: s for i, s in enumerate(stimulus_set)}
+    stimulus_name_rvmap = {s: i for i, s in enumerate(stimulus_set)}
+    stimulus_name_numeral = np.array([stimulus_name_rvmap[x] for x in stimulus_name])
+
+    trial_type_rvmap = {'train': 1, 'test': 2}
+    trial_type_vmap = {v: k for k, v in trial_type_rvmap.items()}
+    trial_type_numeral = np.array([trial_type_rvmap[x] for x in trial_type])
+
+    bdata = bdpy.BData()
+    bdata.add(voxel_data, 'VoxelData')
+    bdata.add(trial_id, 'trial_id')
+    bdata.add(session, 'session')
+    bdata.add(run, 'run')
+    bdata.add(trial_type_numeral, 'trial_type')
+    bdata.add_vmap('trial_type', trial_type_vmap)
+    bdata.add(stimulus_name_numeral, 'stimulus_name')
+    bdata.add_vmap('stimulus_name', stimulus_name_vmap)
+    for k, v in metadatas.items():
+        bdata.add_metadata(k, v, where='VoxelData')
+
+    bdata.save(str(output_file))
+
+
+def _run(queue, func, args, kwargs):
+    t0 = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed = time.perf_counter() - t0
+    queue.put((elapsed, peak_rss()))
+
+
+def run_benchmark(func, *args, **kwargs):
+    """Run `func` in a new process and return wall time (s) and peak RSS (bytes)."""
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    p = ctx.Process(target=_run, args=(queue, func, args, kwargs))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        raise RuntimeError(f'{func.__name__} failed (exit code {p.exitcode})')
+    return queue.get()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-trials', type=int, default=10000)
+    parser.add_argument('--n-voxels', type=int, default=200000)
+    parser.add_argument('--block-sizes', type=int, nargs='*', default=[20000, 5000], help='Block sizes (voxels) for the streaming conversion.')
+    parser.add_argument('--skip-legacy', action='store_true', help='Skip the previous conversion.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_f, stim_f, meta_f = make_synthetic_data(tmp_dir, args.n_trials, args.n_voxels)
+        table_size = args.n_trials * args.n_voxels * 8
+        print(f"Response table: {args.n_voxels} voxels x {args.n_trials} trials ({table_size / 1024 ** 3:.2f} GiB)")
+
+        output_file = Path(tmp_dir) / 'output.h5'
+        methods = {}
+        if not args.skip_legacy:
+            methods['legacy'] = (legacy_make_bdata_things, {})
+        methods['vectorized'] = (make_bdata_things, {})
+        methods['vectorized (float32)'] = (make_bdata_things, {'dtype': np.float32})
+        for block_size in args.block_sizes:
+            methods[f'streaming ({block_size})'] = (make_bdata_things, {'block_size': block_size})
+
+        results = {}
+        for name, (func, kwargs) in methods.items():
+            results[name] = run_benchmark(func, data_f, stim_f, meta_f, output_file, **kwargs)
+
+    print(f"{'method':<24} {'time (s)':>10} {'peak RSS (GiB)':>16} {'peak / table':>14}")
+    for name, (t, peak) in results.items():
+        print(f"{name:<24} {t:>10.2f} {peak / 1024 ** 3:>16.2f} {peak / table_size:>14.2f}")
+    if 'legacy' in results:
+        t_legacy, peak_legacy = results['legacy']
+        for name, (t, peak) in results.items():
+            if name == 'legacy':
+                continue
+            print(f"{name}: {t_legacy / t:.1f}x faster, {peak_legacy / peak:.1f}x less peak memory")
@@ -0,0 +1,110 @@
+"""Benchmark suite of the THINGS-fMRI converter on synthetic data.
+
+Generates synthetic ResponseData, StimulusMetadata and VoxelMetadata files
+(see `bench_make_bdata_thingsfmri.make_synthetic_data`) and times at
+several scales:
+
+- `make_bdata`: `make_bdata_things` (make_bdata_thingsfmri.py).
+- `split`: `split_bdata` of its output into training and test files
+  (make_bdata_thingsfmri_traintestsplit.py).
+
+Each benchmark runs in its own process. The wall time, the throughput
+(trials/s, and MB/s of the response table in float64), and the peak RSS are
+appended to a results file (JSONL) with the current commit, so that the
+results of two commits can be compared:
+
+    % python bench_suite.py --scales small medium
+    % python bench_suite.py --compare <commit> <commit>
+
+Scales (trials x voxels): small 1,000 x 20,000; medium 5,000 x 100,000;
+large 10,000 x 200,000 (about the size of a subject, 16 GB in float64).
+"""
+
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from bdata_utils import split_bdata
+from bench_make_bdata_thingsfmri import make_synthetic_data, run_benchmark
+from make_bdata_thingsfmri import make_bdata_things
+
+
+scales = {
+    'small': (1000, 20000),
+    'medium': (5000, 100000),
+    'large': (10000, 200000),
+}
+
+
+def split_train_test(src_file, training_file, test_file):
+    """Split as make_bdata_thingsfmri_traintestsplit.py."""
+    split_bdata(src_file, {training_file: 'trial_type == 1', test_file: 'trial_type == 2'})
+
+
+def commit() -> str:
+    """Return the current commit (with "-dirty" if the tree has changes)."""
+    root_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root_dir, text=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--', '.'], cwd=root_dir) != 0
+        return rev + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results_file, base, target):
+    """Print time and peak RSS of `target` relative to `base` (latest result of each benchmark and scale)."""
+    results = pd.read_json(results_file, lines=True, dtype={'commit': str})
+    latest = results.groupby(['commit', 'benchmark', 'scale']).last()
+    print(f"{'benchmark':<12} {'scale':<8} {'time ' + base:>16} {'time ' + target:>16} {'speedup':>8} {'peak RSS ratio':>15}")
+    for (benchmark, scale), row in latest.loc[target].iterrows():
+        if (base, benchmark, scale) not in latest.index:
+            continue
+        ref = latest.loc[(base, benchmark, scale)]
+        print(f"{benchmark:<12} {scale:<8} {ref.wall_s:>16.2f} {row.wall_s:>16.2f} {ref.wall_s / row.wall_s:>8.2f} {row.peak_rss / ref.peak_rss:>15.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', nargs='*', default=['small'], choices=list(scales))
+    parser.add_argument('--benchmarks', nargs='*', default=['make_bdata', 'split'], choices=['make_bdata', 'split'])
+    parser.add_argument('--block-size', type=int, default=None, help='Block size (voxels) of make_bdata_things (default: all voxels).')
+    parser.add_argument('--output', default='output/bench_results.jsonl', help='Results file (appended to; default: in the output directory, which is not tracked).')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'TARGET'), help='Compare the results of two commits and exit.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.output, *args.compare)
+        sys.exit()
+
+    rev = commit()
+    for scale in args.scales:
+        n_trials, n_voxels = scales[scale]
+        table_mb = n_trials * n_voxels * 8 / 1024 ** 2
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_f, stim_f, meta_f = make_synthetic_data(tmp_dir, n_trials, n_voxels)
+            output_file = os.path.join(tmp_dir, 'sub-01.h5')
+            results = {}
+            # the split reads the output of make_bdata_things
+            results['make_bdata'] = run_benchmark(make_bdata_things, data_f, stim_f, meta_f, output_file, block_size=args.block_size)
+            if 'split' in args.benchmarks:
+                results['split'] = run_benchmark(split_train_test, output_file, os.path.join(tmp_dir, 'sub-01_training.h5'), os.path.join(tmp_dir, 'sub-01_test.h5'))
+
+        for benchmark in args.benchmarks:
+            t, peak = results[benchmark]
+            result = {
+                'commit': rev, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'benchmark': benchmark, 'scale': scale,
+                'n_trials': n_trials, 'input_mb': table_mb, 'wall_s': t,
+                'trials_per_s': n_trials / t, 'mb_per_s': table_mb / t, 'peak_rss': peak,
+            }
+            os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+            print(f"{benchmark:<12} {scale:<7} {t:>8.2f} s {n_trials / t:>10.1f} trials/s {table_mb / t:>8.1f} MB/s peak RSS {peak / 1024 ** 3:.2f} GiB")
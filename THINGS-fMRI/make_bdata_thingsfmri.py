@@ -1,130 +1,384 @@
-from typing import Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
+import argparse
 import os
 from pathlib import Path
-import csv
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 
-import bdpy
 import numpy as np
 import pandas as pd
 
+from bdata_utils import BDataWriter, ShardedBDataWriter, aggregate_labels, aggregate_rows, available_memory, encode_labels, group_rows, roi_index_from_metadata, shard_index_file_name, shuffle_groups
+from plan_thingsfmri import fit_jobs, format_plan, plan_subject
+
 
 PathType = Union[str, Path]
 
 
-def make_bdata_things(data_f: PathType, stim_f: PathType, meta_f: PathType, output_file: PathType):
-    """Make BData files for THINGS-fMRI dataset."""
+def load_stimulus_metadata(stim_f: PathType) -> Dict[str, np.ndarray]:
+    """Load stimulus metadata as columnar arrays."""
+    stims = pd.read_csv(stim_f)
+    return {
+        'trial_id': stims['trial_id'].to_numpy(dtype=int),
+        'session': stims['session'].to_numpy(dtype=int),
+        'run': stims['run'].to_numpy(dtype=int),
+        'trial_type': stims['trial_type'].to_numpy(dtype=str),  # "train" or "test"
+        'stimulus_name': np.array([os.path.splitext(s)[0] for s in stims['stimulus']]),
+    }
+
+
+def gather_trials(resp: pd.DataFrame, trial_id: np.ndarray, out: np.ndarray, chunk_size: int = 1000) -> np.ndarray:
+    """Gather trial columns of the response table into `out` (trials x voxels).
+
+    Trials are copied in chunks of `chunk_size` columns so that the transient
+    copy stays small compared with the response table.
+    """
+    for i in range(0, len(trial_id), chunk_size):
+        _trial_id = trial_id[i:i + chunk_size]
+        out[i:i + len(_trial_id)] = resp[_trial_id].to_numpy(dtype=out.dtype).T
+    return out
+
+
+def fix_run_numbers(run: np.ndarray, session: np.ndarray) -> np.ndarray:
+    """Renumber runs so that they are unique across sessions."""
+    # The last run number of each session (in trial order)
+    _, last_index_rev, session_index = np.unique(session[::-1], return_index=True, return_inverse=True)
+    last_run = run[len(run) - 1 - last_index_rev]
+    run_inc = last_run[session_index[::-1]]
+    return run + run_inc * (session - 1)
+
+
+def read_voxel_data(data_f: PathType, trial_id: np.ndarray, n_voxels: int, block_size: Optional[int] = None, dtype: type = np.float64) -> Iterator[Tuple[slice, np.ndarray]]:
+    """Read the response table in blocks of voxels.
+
+    Yields the voxel slice and the voxel data (trials x voxels) of each block.
+    If `block_size` is None, the whole table is read at once.
+    """
+    if block_size is None:
+        block_size = n_voxels
+
+    with pd.HDFStore(data_f, 'r') as store:
+        key = store.keys()[0]
+        for start in range(0, n_voxels, block_size):
+            resp = store.select(key, start=start, stop=min(start + block_size, n_voxels))
+            voxel_data = gather_trials(resp, trial_id, np.empty((len(trial_id), resp.shape[0]), dtype=dtype))
+            del resp
+            yield slice(start, start + voxel_data.shape[1]), voxel_data
+
+
+def make_labels(stims: Dict[str, np.ndarray], vocabulary: Optional[PathType] = None) -> Tuple[List[Tuple[str, np.ndarray]], Dict[str, Dict[int, str]]]:
+    """Make the label columns (trial_id, session, run, trial_type, and stimulus_name) and their vmaps.
+
+    Stimulus names are numbered in sorted order from zero, or by `vocabulary`
+    (see `bdata_utils.load_vocabulary`).
+    """
+    # Fix run numbers
+    run = fix_run_numbers(stims['run'], stims['session'])
+    print("Run: ", np.unique(run))
+
+    # Stimulus name vmap setup
+    stimulus_name_numeral, stimulus_name_vmap = encode_labels(stims['stimulus_name'], vocabulary=vocabulary)
+
+    # Trial type vmap setup
+    trial_type_numeral, trial_type_vmap = encode_labels(stims['trial_type'], vocabulary={'train': 1, 'test': 2})
+
+    columns = [
+        ('trial_id', stims['trial_id']),
+        ('session', stims['session']),
+        ('run', run),
+        ('trial_type', trial_type_numeral),
+        ('stimulus_name', stimulus_name_numeral),
+    ]
+    vmaps = {
+        'trial_type': trial_type_vmap,
+        'stimulus_name': stimulus_name_vmap,
+    }
+
+    return columns, vmaps
+
+
+def make_bdata_things(
+        data_f: PathType, stim_f: PathType, meta_f: PathType, output_file: PathType,
+        dtype: type = np.float64, block_size: Optional[int] = None,
+        splits: Optional[Dict[PathType, str]] = None,
+        aggregate: Optional[Dict[PathType, str]] = None,
+        vocabulary: Optional[PathType] = None,
+        chunks: Union[bool, str, Tuple[int, int]] = True,
+        compression: Optional[str] = None,
+        compression_opts=None,
+        shuffle: bool = False,
+        shard_size: Optional[int] = None,
+        shuffle_shards: bool = False,
+        shard_seed: Optional[int] = 0
+):
+    """Make BData files for THINGS-fMRI dataset.
+
+    The response table is read in blocks of `block_size` voxels, and each
+    block is written to the VoxelData columns of the output file, so that
+    the peak memory is bounded by the block size (trials x `block_size`)
+    rather than the size of the table. If `block_size` is None, the whole
+    table is read at once.
+
+    `splits` maps additional output files to selector expressions on the
+    label columns (e.g., `'trial_type == 1'`, see `bdata_utils.split_bdata`).
+    The selected trials are written to the split files from the same blocks,
+    so the response table is read only once.
+
+    `aggregate` maps output files (`output_file` or split files) to an
+    aggregation method ('mean' or 'median'). The trials of the same stimulus
+    are aggregated into one row at write time, and a `n_repetitions` column
+    is added. Label columns which differ between the repetitions (e.g.,
+    trial_id) are NaN in the aggregated rows.
+
+    `vocabulary` is a label vocabulary file (see `bdata_utils.load_vocabulary`)
+    to number the stimulus names, so that they have the same numerals across
+    subjects and datasets.
+
+    The column indices of the ROIs (binary mask columns of the voxel
+    metadata) are saved in `/roi_index` (see `bdata_utils.load_roi`).
+
+    `dtype`, `chunks`, `compression`, `compression_opts`, and `shuffle`
+    set the storage of the output files (see `bdata_utils.BDataWriter`).
+    Use chunks='columns' for files read by ROIs (subsets of voxels).
+
+    With `shard_size`, each output file is written to shards of at most
+    `shard_size` trials and a shard index (see
+    `bdata_utils.ShardedBDataWriter`), with the stimuli in random order over
+    the shards if `shuffle_shards` (seed `shard_seed`). The shards keep the
+    vmaps of the whole data.
+    """
     print("Source data:")
     print(f"\t{data_f}")
     print(f"\t{stim_f}")
     print(f"\t{meta_f}")
 
     # Load voxel metadata and stimulus
-    with open(stim_f, 'r') as f:
-        reader = csv.DictReader(f)
-        stims = [row for row in reader]
-    #print(len(stims))
+    stims = load_stimulus_metadata(stim_f)
 
-    with open(meta_f, 'r') as f:
-        reader = csv.DictReader(f)
-        voxels = [row for row in reader]
-    #print(len(voxels))
+    voxels = pd.read_csv(meta_f, dtype=np.float64, float_precision='round_trip')  # same values as float()
 
-    n_trials = len(stims)
+    n_trials = len(stims['trial_id'])
     n_voxels = len(voxels)
+    print("VoxelData size: ", (n_trials, n_voxels))
 
-    # Load fMRI data
-    resp = pd.read_hdf(data_f)
-    print("fMRI data size: ", resp.shape)
-
-    # Dataset
-    voxel_data_lst = []
-    trial_id = np.array([])
-    trial_type = np.array([])
-    run = np.array([])
-    session = np.array([])
-    stimulus_name = np.array([])
-
-    for stim in stims:
-        _trial_id = int(stim['trial_id'])
-        _session = int(stim['session'])
-        _run = int(stim['run'])
-        _trial_type = stim['trial_type']  # "train" or "test"
-        _stimulus_name = os.path.splitext(stim['stimulus'])[0]
-
-        _trial_resp = resp[_trial_id].values
-
-        voxel_data_lst.append(_trial_resp)
-        trial_id = np.append(trial_id, _trial_id)
-        trial_type = np.append(trial_type, _trial_type)
-        run = np.append(run, _run)
-        session = np.append(session, _session)
-        stimulus_name = np.append(stimulus_name, _stimulus_name)
-
-    voxel_data = np.vstack(voxel_data_lst)
-    print("VoxelData size: ", voxel_data.shape)
-
-    # Fix run numbers
-    run_inc = np.hstack(
-        [
-            np.repeat(
-                run[(session == n).flatten()][-1],
-                np.sum(session == n)
-            )
-            for n in np.unique(session)
-        ]
-    )
-    run = run + run_inc[:] * (session - 1)
-    print("Run: ", np.unique(run))
+    # Labels
+    columns, vmaps = make_labels(stims, vocabulary=vocabulary)
 
     # Voxel metadata
-    metadatas = {k: np.zeros(n_voxels) for k in voxels[0]}
-    for i, voxel in enumerate(voxels):
-        for k, v in voxel.items():
-            metadatas[k][i] = float(v)
+    metadatas = {k: voxels[k].to_numpy() for k in voxels.columns}
+    del voxels
 
-    # Stimulus name vmap setup
-    stimulus_set = np.unique(stimulus_name)
-    stimulus_name_vmap = {i: s for i, s in enumerate(stimulus_set)}
-    stimulus_name_rvmap = {s: i for i, s in enumerate(stimulus_set)}
-    #print(len(stimulus_name_vmap))
-    #print(len(stimulus_name_rvmap))
-    stimulus_name_numeral = np.array([stimulus_name_rvmap[x] for x in stimulus_name])
+    # ROI column indices (binary mask columns in the voxel metadata)
+    roi_index = roi_index_from_metadata(metadatas, exclude=('voxel_id', 'voxel_x', 'voxel_y', 'voxel_z'))
 
-    # Trial type vmap setup
-    trial_type_rvmap = {'train': 1, 'test': 2}
-    trial_type_vmap = {v: k for k, v in trial_type_rvmap.items()}
-    trial_type_numeral = np.array([trial_type_rvmap[x] for x in trial_type])
+    # Trials of each output file
+    outputs = {str(output_file): np.ones(n_trials, dtype=bool)}
+    if splits is not None:
+        labels = pd.DataFrame({k: v for k, v in columns})
+        for split_file, selector in splits.items():
+            outputs[str(split_file)] = np.asarray(labels.eval(selector), dtype=bool)
+
+    # Repetitions of each stimulus in aggregated output files
+    aggregate = {str(f): method for f, method in (aggregate or {}).items()}
+    groups = {}
+    for f, method in aggregate.items():
+        index = np.flatnonzero(outputs[f])
+        order, starts, _ = group_rows(dict(columns)['stimulus_name'][index])
+        groups[f] = (index[order], starts, method)
 
     # Make BData
-    bdata = bdpy.BData()
+    with ExitStack() as stack:
+        writers = {}
+        for f, mask in outputs.items():
+            if f in groups:
+                n_samples = len(groups[f][1])
+                extra_columns = [('n_repetitions', 1)]
+            else:
+                n_samples = int(np.sum(mask))
+                extra_columns = []
+            bdata_columns = [('VoxelData', n_voxels)] + [(k, 1) for k, _ in columns] + extra_columns
+            storage = dict(dtype=dtype, chunks=chunks, compression=compression, compression_opts=compression_opts, shuffle=shuffle)
+            if shard_size is None:
+                writer = BDataWriter(f, n_samples, bdata_columns, **storage)
+            else:
+                order = None
+                if shuffle_shards:
+                    stimulus = dict(columns)['stimulus_name']
+                    order = shuffle_groups(stimulus[groups[f][0]][groups[f][1]] if f in groups else stimulus[mask], shard_seed)
+                writer = ShardedBDataWriter(f, n_samples, bdata_columns, shard_size, order=order, **storage)
+            writers[f] = stack.enter_context(writer)
+
+        # Load fMRI data
+        for voxel_slice, voxel_data in read_voxel_data(data_f, stims['trial_id'], n_voxels, block_size=block_size, dtype=dtype):
+            for f, bdata in writers.items():
+                mask = outputs[f]
+                if f in groups:
+                    rows, starts, method = groups[f]
+                    bdata.write('VoxelData', aggregate_rows(voxel_data[rows], starts, method), columns=voxel_slice)
+                else:
+                    bdata.write('VoxelData', voxel_data if mask.all() else voxel_data[mask], columns=voxel_slice)
+            print(f"VoxelData: {voxel_slice.stop}/{n_voxels} voxels")
+            del voxel_data
+
+        for f, bdata in writers.items():
+            if f in groups:
+                rows, starts, _ = groups[f]
+                for k, v in columns:
+                    bdata.write(k, aggregate_labels(v[rows], starts))
+                bdata.write('n_repetitions', np.diff(np.r_[starts, len(rows)]).astype(float))
+            else:
+                for k, v in columns:
+                    bdata.write(k, v[outputs[f]])
+            for k, v in vmaps.items():
+                # Split files and shards keep the vmaps of the whole data
+                bdata.add_vmap(k, v, prune=f == str(output_file) and shard_size is None)
+
+            for k, v in metadatas.items():
+                bdata.add_metadata(k, v, where='VoxelData')
+            for k, v in roi_index.items():
+                bdata.add_roi_index(k, v, where='VoxelData')
+
+    for f, mask in outputs.items():
+        saved_file = f if shard_size is None else shard_index_file_name(f)
+        if f in groups:
+            print(f"Saved {saved_file} ({len(groups[f][1])} stimuli, {groups[f][2]} of {np.sum(mask)} trials)")
+        else:
+            print(f"Saved {saved_file} ({np.sum(mask)} trials)")
+
+
+def peak_rss() -> int:
+    """Return the peak RSS (bytes) of the current process."""
+    # `ru_maxrss` is inherited across exec, so VmHWM is used where available.
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KiB on Linux
+
+
+_admission = None
+
 
-    bdata.add(voxel_data, 'VoxelData')
-    bdata.add(trial_id, 'trial_id')
-    bdata.add(session, 'session')
-    bdata.add(run, 'run')
-    bdata.add(trial_type_numeral, 'trial_type')
-    bdata.add_vmap('trial_type', trial_type_vmap)
-    bdata.add(stimulus_name_numeral, 'stimulus_name')
-    bdata.add_vmap('stimulus_name', stimulus_name_vmap)
+def _init_worker(admission):
+    global _admission
+    _admission = admission
 
-    for k, v in metadatas.items():
-        bdata.add_metadata(k, v, where='VoxelData')
 
-    bdata.save(output_file)
-    print(f"Saved {output_file}")
+def _convert_subject(sub: str, kwargs: dict) -> Tuple[str, float, float, int]:
+    """Convert one subject in a worker process.
+
+    Returns the subject, the waiting time for admission (s), the conversion
+    time (s), and the peak RSS (bytes).
+    """
+    t0 = time.perf_counter()
+    with _admission:
+        t1 = time.perf_counter()
+        make_bdata_things(**kwargs)
+    return sub, t1 - t0, time.perf_counter() - t1, peak_rss()
+
+
+def convert_subjects(
+        jobs: Dict[str, dict], n_jobs: int = 1, max_in_memory: Optional[int] = None
+) -> List[Tuple[str, float, float, int]]:
+    """Run `make_bdata_things` for subjects in a process pool.
+
+    `jobs` maps subjects to keyword arguments of `make_bdata_things`. At most
+    `max_in_memory` subjects (default: `n_jobs`) are converted at the same
+    time, so that only that many response tables are held in RAM at once.
+    Each subject runs in a fresh process so that its peak RSS is measured.
+
+    Returns (subject, waiting time, conversion time, peak RSS) of each subject.
+    """
+    if max_in_memory is None:
+        max_in_memory = n_jobs
+
+    ctx = multiprocessing.get_context('spawn')
+    admission = ctx.BoundedSemaphore(max_in_memory)
+
+    with ProcessPoolExecutor(
+            max_workers=n_jobs, mp_context=ctx, max_tasks_per_child=1,
+            initializer=_init_worker, initargs=(admission,)
+    ) as executor:
+        futures = [executor.submit(_convert_subject, sub, kwargs) for sub, kwargs in jobs.items()]
+        results = [f.result() for f in futures]
+
+    print("Summary:")
+    print(f"\t{'subject':<10} {'wait (s)':>10} {'time (s)':>10} {'peak RSS (GiB)':>16}")
+    for sub, t_wait, t_run, rss in results:
+        print(f"\t{sub:<10} {t_wait:>10.1f} {t_run:>10.1f} {rss / 1024 ** 3:>16.2f}")
+
+    return results
 
 
 if __name__ == "__main__":
-    src_dir = Path('./src/fMRI-Single-Trial-Responses-table-format/betas_csv')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subjects', nargs='*', default=['sub-01', 'sub-02', 'sub-03'])
+    parser.add_argument('--block-size', type=int, default=None, help='Number of voxels read at once (default: all voxels).')
+    parser.add_argument('--n-jobs', type=int, default=1, help='Number of subjects converted in parallel.')
+    parser.add_argument('--max-in-memory', type=int, default=None, help='Maximum number of subjects loaded in RAM at the same time (default: --n-jobs).')
+    parser.add_argument('--split', action='store_true', help='Also write training/test files (same as make_bdata_thingsfmri_traintestsplit.py).')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64', help='Storage dtype of the output files.')
+    parser.add_argument('--chunks', choices=['auto', 'rows', 'columns'], default='auto', help='HDF5 chunk layout (columns: fast reads of ROIs).')
+    parser.add_argument('--compression', choices=['gzip', 'lzf'], default=None, help='HDF5 compression filter.')
+    parser.add_argument('--compression-level', type=int, default=None, help='Compression level (gzip: 0-9).')
+    parser.add_argument('--shuffle', action='store_true', help='Apply the HDF5 shuffle filter (improves the compression of floats).')
+    parser.add_argument('--vocabulary', type=str, default=None, help='Label vocabulary file (CSV/TSV with label and index columns) to number the stimulus names.')
+    parser.add_argument('--memory-check', choices=['reduce', 'error', 'off'], default='reduce', help='Planned memory of the subjects (see plan_thingsfmri.py): reduce the subjects in memory at the same time to fit the available memory, refuse to run (error), or no check (off).')
+    parser.add_argument('--shard-size', type=int, default=None, help='Write each output file to shards of this number of trials, with a shard index (default: one file).')
+    parser.add_argument('--shuffle-shards', action='store_true', help='Shuffle the stimuli over the shards (the repetitions of a stimulus are kept together).')
+    parser.add_argument('--shard-seed', type=int, default=0, help='Seed of the stimulus shuffle of --shuffle-shards.')
+    parser.add_argument('--aggregate-test', choices=['mean', 'median'], default=None, help='Also write a test file with the repetitions of each stimulus averaged (or their median).')
+    args = parser.parse_args()
 
-    subs = ['sub-01', 'sub-02', 'sub-03']
+    src_dir = Path('./src/fMRI-Single-Trial-Responses-table-format/betas_csv')
+    output_dir = Path("output")
 
-    for sub in subs:
+    jobs = {}
+    for sub in args.subjects:
         data_f = src_dir / f"{sub}_ResponseData.h5"
         stim_f = src_dir / f"{sub}_StimulusMetadata.csv"
         meta_f = src_dir / f"{sub}_VoxelMetadata.csv"
 
-        output_file = Path("output") / f"{sub}.h5"
+        output_file = output_dir / f"{sub}.h5"
+
+        splits = {}
+        if args.split:
+            splits[output_dir / f"{sub}_training.h5"] = 'trial_type == 1'
+            splits[output_dir / f"{sub}_test.h5"] = 'trial_type == 2'
+        aggregate = {}
+        if args.aggregate_test:
+            aggregate_file = output_dir / f"{sub}_test_{args.aggregate_test}.h5"
+            splits[aggregate_file] = 'trial_type == 2'
+            aggregate[aggregate_file] = args.aggregate_test
+
+        jobs[sub] = dict(
+            data_f=data_f, stim_f=stim_f, meta_f=meta_f, output_file=output_file,
+            block_size=args.block_size, splits=splits, aggregate=aggregate,
+            vocabulary=args.vocabulary, dtype=np.dtype(args.dtype), chunks=args.chunks,
+            compression=args.compression, compression_opts=args.compression_level, shuffle=args.shuffle,
+            shard_size=args.shard_size, shuffle_shards=args.shuffle_shards, shard_seed=args.shard_seed
+        )
+
+    # Fit the subjects in memory at the same time in the available memory (from the headers of the inputs)
+    max_in_memory = args.max_in_memory or args.n_jobs
+    if args.memory_check != 'off':
+        plans = {}
+        for sub, job in jobs.items():
+            plans[sub] = plan_subject(job['data_f'], job['stim_f'], job['meta_f'], dtype=job['dtype'], block_size=job['block_size'], split=bool(job['splits']))
+            print(format_plan(sub, plans[sub]))
+        n_fit = fit_jobs(plans, max_in_memory)
+        if n_fit == 0 or (args.memory_check == 'error' and n_fit < max_in_memory):
+            raise MemoryError(
+                f"Converting {max_in_memory} subjects at the same time would exceed the available memory ({available_memory() / 1024 ** 3:.1f} GiB); "
+                f"use a smaller --block-size or --max-in-memory (--memory-check off disables the check)"
+            )
+        if n_fit < max_in_memory:
+            print(f"Reduced the subjects in memory at the same time from {max_in_memory} to {n_fit} to fit the available memory")
+            max_in_memory = n_fit
 
-        make_bdata_things(data_f, stim_f, meta_f, output_file)
+    convert_subjects(jobs, n_jobs=args.n_jobs, max_in_memory=max_in_memory)
@@ -0,0 +1,156 @@
+"""Build plan of the THINGS-fMRI conversion from the headers of the inputs.
+
+The inputs are inspected without reading their data: the shape and dtype of
+the response table are read from the HDF5 headers of ResponseData (pandas
+fixed format, one row per voxel and one column per trial), and the numbers
+of trials and voxels from the rows of StimulusMetadata and VoxelMetadata.
+The plan has the shape of each output file and an estimate of the peak
+memory of `make_bdata_things`, from which the number of subjects converted
+at the same time is fitted in the available memory (see `fit_jobs`).
+
+    % python plan_thingsfmri.py --subjects sub-01 sub-02 sub-03 --split
+"""
+
+
+from typing import Dict, Optional, Union
+
+import argparse
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from bdata_utils import available_memory
+
+
+PathType = Union[str, Path]
+
+# memory of a worker process besides the data (Python, pandas, and the libraries)
+process_overhead = 256 * 1024 ** 2
+
+# number of trials copied at a time from the response table (see `make_bdata_thingsfmri.gather_trials`)
+gather_chunk_size = 1000
+
+
+def count_rows(csv_file: PathType) -> int:
+    """Return the number of rows of a CSV file (without the header), counting the lines only."""
+    n_lines, last = 0, b'\n'
+    with open(csv_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            n_lines += block.count(b'\n')
+            last = block[-1:]
+    return n_lines + (last != b'\n') - 1
+
+
+def inspect_response_data(data_f: PathType) -> Dict:
+    """Return the shape (voxels x columns) of the response table and the dtype of its float blocks.
+
+    The shape of a pandas fixed-format table is read from the HDF5 headers of
+    its blocks, and that of a table-format table from the pandas storer
+    (both are read by `make_bdata_thingsfmri.read_voxel_data`).
+    """
+    with h5py.File(str(data_f), 'r') as f:
+        group = f[next(iter(f.keys()))]
+        if 'nblocks' in group.attrs:
+            blocks = [group[f'block{i}_values'] for i in range(int(group.attrs['nblocks']))]
+            n_rows = blocks[0].shape[0]
+            float_blocks = [b for b in blocks if np.issubdtype(b.dtype, np.floating)]
+            return {
+                'shape': (n_rows, sum(b.shape[1] for b in blocks)),
+                'dtype': float_blocks[0].dtype if float_blocks else np.dtype(np.float64),
+            }
+
+    with pd.HDFStore(str(data_f), 'r') as store:
+        storer = store.get_storer(store.keys()[0])
+        if not storer.is_table:
+            raise ValueError(f'Unsupported response table format in {data_f}')
+        float_dtypes = [np.dtype(str(axis.dtype)) for axis in storer.values_axes if np.issubdtype(np.dtype(str(axis.dtype)), np.floating)]
+        return {
+            'shape': (int(storer.nrows), int(storer.ncols)),
+            'dtype': float_dtypes[0] if float_dtypes else np.dtype(np.float64),
+        }
+
+
+def plan_subject(
+        data_f: PathType, stim_f: PathType, meta_f: PathType,
+        dtype: type = np.float64, block_size: Optional[int] = None,
+        split: bool = False,
+) -> Dict:
+    """Return the build plan of `make_bdata_things` for a subject.
+
+    The memory of a stage is the data it holds at its peak: `read` a block
+    of the response table (`block_size` voxels x all columns), `gather` the
+    trials of the block (trials x `block_size` in `dtype`, and a chunk of
+    trials being copied), `write` the trials of a split copied from the
+    block (if `split`, i.e., split or aggregated files are written; bounded
+    by all the trials, since the selectors need the labels), and `metadata`
+    the voxel metadata. The peak memory of a subject is their sum.
+    """
+    table = inspect_response_data(data_f)
+    n_trials = count_rows(stim_f)
+    n_voxels = count_rows(meta_f)
+    if n_voxels != table['shape'][0]:
+        raise ValueError(f'{meta_f} has {n_voxels} voxels, but {data_f} has {table["shape"][0]}')
+    with open(meta_f) as f:
+        n_meta_columns = len(f.readline().split(','))
+
+    itemsize = np.dtype(dtype).itemsize
+    block = n_voxels if block_size is None else min(block_size, n_voxels)
+    stages = {
+        'read': block * table['shape'][1] * table['dtype'].itemsize,
+        'gather': n_trials * block * itemsize + min(n_trials, gather_chunk_size) * block * 8 * 2,
+        'write': n_trials * block * itemsize if split else 0,
+        'metadata': n_voxels * n_meta_columns * 8 * 2,
+    }
+    return {
+        'n_trials': n_trials,
+        'n_voxels': n_voxels,
+        'table_shape': table['shape'],
+        'output_shape': (n_trials, n_voxels + 5),  # VoxelData and the label columns
+        'stages': stages,
+        'peak_memory': process_overhead + sum(stages.values()),
+    }
+
+
+def fit_jobs(plans: Dict[str, Dict], n_jobs: int, available: Optional[int] = None) -> int:
+    """Return the number of subjects, up to `n_jobs`, which can be converted at the same time in the available memory.
+
+    Returns 0 if the largest subject alone does not fit (use a smaller
+    `block_size`).
+    """
+    if available is None:
+        available = available_memory()
+    peak = max(plan['peak_memory'] for plan in plans.values())
+    return int(min(n_jobs, available // peak))
+
+
+def format_plan(subject: str, plan: Dict) -> str:
+    """Return the plan of a subject as text."""
+    gib = 1024 ** 3
+    stages = ', '.join(f'{k} {v / gib:.2f}' for k, v in plan['stages'].items())
+    return (
+        f"{subject}: {plan['n_trials']} trials x {plan['n_voxels']} voxels (output {plan['output_shape'][0]} x {plan['output_shape'][1]}), "
+        f"memory (GiB): {stages}, peak {plan['peak_memory'] / gib:.2f}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subjects', nargs='*', default=['sub-01', 'sub-02', 'sub-03'])
+    parser.add_argument('--block-size', type=int, default=None, help='Number of voxels read at once (default: all voxels).')
+    parser.add_argument('--n-jobs', type=int, default=1, help='Number of subjects converted in parallel.')
+    parser.add_argument('--split', action='store_true', help='Training/test or aggregated files are also written.')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64', help='Storage dtype of the output files.')
+    args = parser.parse_args()
+
+    src_dir = Path('./src/fMRI-Single-Trial-Responses-table-format/betas_csv')
+    plans = {}
+    for sub in args.subjects:
+        plans[sub] = plan_subject(
+            src_dir / f"{sub}_ResponseData.h5", src_dir / f"{sub}_StimulusMetadata.csv", src_dir / f"{sub}_VoxelMetadata.csv",
+            dtype=np.dtype(args.dtype), block_size=args.block_size, split=args.split,
+        )
+        print(format_plan(sub, plans[sub]))
+    n = fit_jobs(plans, args.n_jobs)
+    print(f"Available memory: {available_memory() / 1024 ** 3:.1f} GiB; subjects converted at the same time: {n} (of --n-jobs {args.n_jobs})")
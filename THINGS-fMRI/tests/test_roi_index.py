@@ -0,0 +1,27 @@
+import numpy as np
+
+from bdata_utils import roi_index_from_metadata
+
+
+def test_roi_index_from_metadata():
+    metadata = {
+        'voxel_id': np.array([0, 1, 2, 3], dtype=float),
+        'voxel_x': np.array([0, 1, 0, 1], dtype=float),
+        'V1': np.array([1, 1, 0, 0], dtype=float),
+        'LOC': np.array([0, 0, 0, 1], dtype=float),
+        'nc_testset': np.array([0.1, 0.5, 0.9, 1.0]),
+    }
+    roi_index = roi_index_from_metadata(metadata, exclude=('voxel_id', 'voxel_x'))
+    assert list(roi_index) == ['V1', 'LOC']
+    np.testing.assert_array_equal(roi_index['V1'], [0, 1])
+    np.testing.assert_array_equal(roi_index['LOC'], [3])
+
+
+def test_constant_columns_are_not_rois():
+    # e.g., a subject or hemisphere flag which is the same for all the voxels
+    metadata = {
+        'V1': np.array([1, 0, 0, 1], dtype=float),
+        'all_voxels': np.ones(4),
+        'empty': np.zeros(4),
+    }
+    assert list(roi_index_from_metadata(metadata)) == ['V1']